@@ -0,0 +1,180 @@
+from bisect import insort
+from collections import namedtuple
+from collections import OrderedDict
+
+# A consolidated temperature reading of a person, in centikelvin.
+PersonReading = namedtuple('PersonReading', ['track_id', 'count', 'ewma',
+                                             'max', 'quantile'])
+
+
+# Estimates a quantile of a stream in constant memory with the P² algorithm
+# (Jain & Chlamtac, 1985), which adjusts five markers with piecewise-parabolic
+# interpolation instead of storing observations. The markers need many
+# observations to settle, so the first exact_samples observations are stored
+# and their quantile is exact. The markers then start out on them.
+class P2Quantile(object):
+    def __init__(self, quantile, exact_samples=5):
+        self._quantile = quantile
+        self._exact_samples = max(exact_samples, 5)
+        self._samples = []
+        self._heights = None
+        self._positions = None
+        self._desired = None
+        self._fractions = [0, quantile / 2, quantile, (1 + quantile) / 2, 1]
+
+    def add(self, value):
+        if self._heights is None:
+            insort(self._samples, value)
+            if len(self._samples) > self._exact_samples:
+                self._start_markers()
+            return
+        heights = self._heights
+
+        # Find the cell of the new value, extending the extremes if needed.
+        if value < heights[0]:
+            heights[0] = value
+            cell = 0
+        elif value >= heights[4]:
+            heights[4] = value
+            cell = 3
+        else:
+            cell = 0
+            while value >= heights[cell + 1]:
+                cell += 1
+
+        positions = self._positions
+        for index in range(cell + 1, 5):
+            positions[index] += 1
+        for index in range(5):
+            self._desired[index] += self._fractions[index]
+
+        # Move the middle markers towards their desired positions.
+        for index in range(1, 4):
+            offset = self._desired[index] - positions[index]
+            if ((offset >= 1 and
+                 positions[index + 1] - positions[index] > 1) or
+                    (offset <= -1 and
+                     positions[index - 1] - positions[index] < -1)):
+                step = 1 if offset > 0 else -1
+                height = self._parabolic(index, step)
+                if not heights[index - 1] < height < heights[index + 1]:
+                    height = self._linear(index, step)
+                heights[index] = height
+                positions[index] += step
+
+    def value(self):
+        if self._heights is None:
+            if not self._samples:
+                return None
+            # Interpolate linearly between the closest ranks, like
+            # np.quantile.
+            position = self._quantile * (len(self._samples) - 1)
+            lower = int(position)
+            upper = min(lower + 1, len(self._samples) - 1)
+            return self._samples[lower] + (position - lower) * (
+                self._samples[upper] - self._samples[lower])
+        return self._heights[2]
+
+    def _start_markers(self):
+        # Place the markers on the sorted samples as close to their desired
+        # positions as they can be while staying distinct, and drop the
+        # samples.
+        samples = self._samples
+        self._desired = [(len(samples) - 1) * fraction
+                         for fraction in self._fractions]
+        positions = [int(round(desired)) for desired in self._desired]
+        for index in range(1, 4):
+            positions[index] = max(positions[index], positions[index - 1] + 1)
+        for index in range(3, 0, -1):
+            positions[index] = min(positions[index], positions[index + 1] - 1)
+        self._positions = positions
+        self._heights = [samples[position] for position in positions]
+        self._samples = None
+
+    def _parabolic(self, index, step):
+        heights = self._heights
+        positions = self._positions
+        return heights[index] + step / (
+            positions[index + 1] - positions[index - 1]) * (
+            (positions[index] - positions[index - 1] + step) *
+            (heights[index + 1] - heights[index]) /
+            (positions[index + 1] - positions[index]) +
+            (positions[index + 1] - positions[index] - step) *
+            (heights[index] - heights[index - 1]) /
+            (positions[index] - positions[index - 1]))
+
+    def _linear(self, index, step):
+        heights = self._heights
+        positions = self._positions
+        return heights[index] + step * (
+            heights[index + step] - heights[index]) / (
+            positions[index + step] - positions[index])
+
+
+# Streaming statistics of one person's temperatures in constant memory. The
+# quantile is exact for the first exact_samples temperatures.
+class RunningStats(object):
+    def __init__(self, ewma_alpha, quantile, exact_samples=5):
+        self._ewma_alpha = ewma_alpha
+        self.count = 0
+        self.ewma = None
+        self.max = None
+        self.quantile = P2Quantile(quantile, exact_samples=exact_samples)
+        self.timestamp = None
+
+    def add(self, value, timestamp):
+        self.count += 1
+        if self.ewma is None:
+            self.ewma = value
+            self.max = value
+        else:
+            self.ewma += self._ewma_alpha * (value - self.ewma)
+            self.max = max(self.max, value)
+        self.quantile.add(value)
+        self.timestamp = timestamp
+
+
+# Aggregates the temperatures of each tracked person and emits one reading per
+# person once there are enough samples. The quantile of a reading is exact,
+# since it is taken before the streaming estimate settles. Memory is bounded
+# by evicting the least recently updated people.
+class TemperatureAggregator(object):
+    def __init__(self, min_samples=10, max_people=100, max_age=10,
+                 ewma_alpha=0.2, quantile=0.9):
+        self._min_samples = min_samples
+        self._max_people = max_people
+        self._max_age = max_age
+        self._ewma_alpha = ewma_alpha
+        self._quantile = quantile
+        self._people = OrderedDict()
+
+    def add(self, track_id, temperature, timestamp):
+        # Returns a PersonReading when the person reaches enough samples, or
+        # None otherwise.
+        stats = self._people.get(track_id)
+        if stats is None:
+            stats = RunningStats(self._ewma_alpha, self._quantile,
+                                 exact_samples=self._min_samples)
+            self._people[track_id] = stats
+        else:
+            self._people.move_to_end(track_id)
+        stats.add(float(temperature), timestamp)
+        self._evict(timestamp)
+
+        if stats.count != self._min_samples:
+            return None
+        return PersonReading(track_id, stats.count, stats.ewma, stats.max,
+                             stats.quantile.value())
+
+    def __len__(self):
+        return len(self._people)
+
+    def _evict(self, timestamp):
+        # The least recently updated people come first.
+        while len(self._people) > self._max_people:
+            self._people.popitem(last=False)
+        while self._people:
+            stats = next(iter(self._people.values()))
+            if timestamp - stats.timestamp <= self._max_age:
+                break
+            self._people.popitem(last=False)
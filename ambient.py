@@ -0,0 +1,93 @@
+from absl import logging
+from collections import deque
+from collections import namedtuple
+from threading import Event
+from threading import Thread
+from time import time
+
+# A single reading in °C, hPa, and %, respectively.
+AmbientData = namedtuple('AmbientData', ['timestamp', 'temperature',
+                                         'pressure', 'humidity'])
+
+# The latest reading along with the average over recent readings.
+AmbientSnapshot = namedtuple('AmbientSnapshot', ['latest', 'average'])
+
+
+def open_bme680(bus=1):
+    # Only load the sensor libraries when the sensor is actually used.
+    import bme680
+    from smbus2 import SMBus
+
+    sensor = bme680.BME680(i2c_addr=bme680.I2C_ADDR_PRIMARY,
+                           i2c_device=SMBus(bus))
+    # TODO: Tune settings.
+    sensor.set_humidity_oversample(bme680.OS_2X)
+    sensor.set_pressure_oversample(bme680.OS_4X)
+    sensor.set_temperature_oversample(bme680.OS_8X)
+    sensor.set_filter(bme680.FILTER_SIZE_3)
+    sensor.set_gas_status(bme680.DISABLE_GAS_MEAS)
+    return sensor
+
+
+# Samples the ambient sensor on a background thread, since conditions change
+# slowly but each reading is a blocking I2C transaction. Readers get the latest
+# snapshot without locking, because snapshots are immutable and replaced with
+# a single assignment. The duration of each reading is observed by an
+# optional metrics histogram.
+class AmbientSampler(object):
+    def __init__(self, sensor, period=1, window=10, read_histogram=None):
+        self._sensor = sensor
+        self._read_histogram = read_histogram
+        self._period = period
+        self._readings = deque(maxlen=window)
+        self._snapshot = None
+
+    def __enter__(self):
+        # Take the first reading right away, so that there is a snapshot.
+        self._sample()
+
+        self._stop_event = Event()
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._stop_event.set()
+        self._thread.join()
+
+    def snapshot(self):
+        # The latest AmbientSnapshot, or None if there was no reading yet.
+        return self._snapshot
+
+    def _run(self):
+        while not self._stop_event.wait(self._period):
+            self._sample()
+
+    def _sample(self):
+        try:
+            start_time = time()
+            ready = self._sensor.get_sensor_data()
+            if self._read_histogram:
+                self._read_histogram.observe(time() - start_time)
+            if not ready:
+                logging.warning('Ambient sensor data not ready')
+                return
+        except IOError as error:
+            logging.warning('Failed to read ambient sensor: %s' % error)
+            return
+
+        data = self._sensor.data
+        latest = AmbientData(time(), data.temperature, data.pressure,
+                             data.humidity)
+        logging.debug('Ambient temperature: %.f °C' % latest.temperature)
+        logging.debug('Ambient pressure: %.f hPa' % latest.pressure)
+        logging.debug('Ambient humidity: %.f %%' % latest.humidity)
+
+        self._readings.append(latest)
+        count = len(self._readings)
+        average = AmbientData(
+            latest.timestamp,
+            sum(reading.temperature for reading in self._readings) / count,
+            sum(reading.pressure for reading in self._readings) / count,
+            sum(reading.humidity for reading in self._readings) / count)
+        self._snapshot = AmbientSnapshot(latest, average)
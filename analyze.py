@@ -0,0 +1,199 @@
+from absl import app
+from absl import flags
+from absl import logging
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
+from fever import open_detector
+from framesource import load_frames
+import json
+from measure import measure_faces
+import multiprocessing
+import os
+from preprocess import Preprocessor
+import signal
+import sys
+from time import time
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string('analyze_output', None, 'The JSON lines file to write '
+                    'the faces found in the recordings to.')
+flags.DEFINE_integer('analyze_workers', None, 'The number of worker '
+                     'processes. Defaults to the number of CPUs.')
+flags.DEFINE_integer('analyze_chunk_frames', 500, 'The number of frames each '
+                     'worker processes at a time.')
+flags.DEFINE_string('analyze_checkpoint', None, 'The file to record finished '
+                    'chunks in. Defaults to the output file with a '
+                    '.checkpoint suffix.')
+flags.DEFINE_bool('analyze_resume', False, 'Whether to resume from the '
+                  'checkpoint of a previous, interrupted run with the same '
+                  'recordings and chunk size.')
+
+# The detector of each worker process, loaded once.
+worker_detector = None
+
+
+def plan_chunks(paths, chunk_frames):
+    # Split the recordings into (path, start, stop) frame ranges, without
+    # reading any frames.
+    chunks = []
+    for path in paths:
+        frames, _ = load_frames(path)
+        for start in range(0, len(frames), chunk_frames):
+            chunks.append((path, start, min(start + chunk_frames,
+                                            len(frames))))
+    return chunks
+
+
+def init_worker(argv):
+    # Worker processes are spawned, so they need to parse the flags again.
+    # They stop when the main process does, rather than on SIGINT.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    FLAGS(argv, known_only=True)
+    global worker_detector
+    worker_detector = open_detector()
+
+
+def analyze_chunk(chunk):
+    # Detect and measure the faces in a range of frames, independently of
+    # other chunks. Each face is detected in every frame, since tracking
+    # would depend on earlier frames. Returns the chunk and the lines to
+    # write.
+    path, start, stop = chunk
+    frames, timestamps = load_frames(path)
+    _, height, width = frames.shape
+    preprocessor = Preprocessor((height, width), FLAGS.min_temperature,
+                                FLAGS.max_temperature)
+    raw = preprocessor.raw(0)
+
+    lines = []
+    for index in range(start, stop):
+        # Only the frames of the chunk are read from the mapped file.
+        raw[...] = frames[index]
+        preprocessor.process(0)
+        faces = worker_detector.detect(preprocessor.scaled(0),
+                                       FLAGS.face_confidence,
+                                       FLAGS.max_num_faces)
+        face_stats = measure_faces(
+            raw, [face.bounding_box for face in faces],
+            percentile=FLAGS.temperature_percentile,
+            inner_fraction=FLAGS.inner_face_fraction)
+        timestamp = (float(timestamps[index]) if timestamps is not None
+                     else None)
+        for face, stats in zip(faces, face_stats):
+            (left, top), (right, bottom) = face.bounding_box
+            lines.append(json.dumps({
+                'path': path,
+                'frame': index,
+                'timestamp': timestamp,
+                'score': float(face.score),
+                'bbox': [float(left), float(top), float(right),
+                         float(bottom)],
+                'max': float(stats['max']),
+                'percentile': float(stats['percentile']),
+                'mean': float(stats['mean']),
+                'pixels': int(stats['pixels']),
+            }) + '\n')
+    return chunk, lines
+
+
+def read_checkpoint(path):
+    # The finished chunks and the size of the output when the last of them
+    # was written.
+    finished = set()
+    output_size = 0
+    with open(path) as checkpoint_file:
+        for line in checkpoint_file:
+            entry = json.loads(line)
+            finished.add((entry['path'], entry['start'], entry['stop']))
+            output_size = max(output_size, entry['output_size'])
+    return finished, output_size
+
+
+def main(argv):
+    paths = argv[1:]
+    if not paths:
+        raise app.UsageError('Expected one or more recordings to analyze.')
+    if not FLAGS.analyze_output:
+        raise app.UsageError('--analyze_output is required.')
+    num_workers = FLAGS.analyze_workers or os.cpu_count()
+    if FLAGS.detector == 'edgetpu' and num_workers > 1:
+        raise app.UsageError('The Edge TPU can only be used by a single '
+                             'worker. Use --analyze_workers=1 or '
+                             '--detector=cpu.')
+    checkpoint_path = (FLAGS.analyze_checkpoint or
+                       FLAGS.analyze_output + '.checkpoint')
+
+    chunks = plan_chunks(paths, FLAGS.analyze_chunk_frames)
+    if FLAGS.analyze_resume and os.path.exists(checkpoint_path):
+        finished, output_size = read_checkpoint(checkpoint_path)
+        if not finished <= set(chunks):
+            raise app.UsageError('The checkpoint is from different recordings '
+                                 'or a different chunk size.')
+        chunks = [chunk for chunk in chunks if chunk not in finished]
+        mode = 'a'
+        logging.info('Resuming with %d chunks left' % len(chunks))
+    else:
+        output_size = 0
+        mode = 'w'
+
+    with open(FLAGS.analyze_output, mode) as output_file, \
+            open(checkpoint_path, mode) as checkpoint_file:
+        # Drop any output written after the last checkpoint, since its chunk
+        # is processed again.
+        output_file.truncate(output_size)
+        output_file.seek(output_size)
+
+        # Keep a few chunks per worker in flight, so that results are written
+        # as they come in instead of piling up in memory.
+        start_time = time()
+        num_frames = 0
+        num_faces = 0
+        pending = set()
+        remaining = iter(chunks)
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(num_workers, mp_context=context,
+                                 initializer=init_worker,
+                                 initargs=(sys.argv,)) as executor:
+            try:
+                while True:
+                    for chunk in remaining:
+                        pending.add(executor.submit(analyze_chunk, chunk))
+                        if len(pending) >= 2 * num_workers:
+                            break
+                    if not pending:
+                        break
+                    done, pending = wait(pending,
+                                         return_when=FIRST_COMPLETED)
+                    for future in done:
+                        (path, start, stop), lines = future.result()
+                        output_file.writelines(lines)
+                        output_file.flush()
+
+                        # Only mark the chunk as finished once its results
+                        # are on disk.
+                        os.fsync(output_file.fileno())
+                        checkpoint_file.write(json.dumps({
+                            'path': path, 'start': start, 'stop': stop,
+                            'output_size': output_file.tell()}) + '\n')
+                        checkpoint_file.flush()
+
+                        num_frames += stop - start
+                        num_faces += len(lines)
+                        logging.info('%s: frames %d to %d, %d faces' % (
+                            path, start, stop, len(lines)))
+
+            # Stop on SIGINT, after the chunks in progress.
+            except KeyboardInterrupt:
+                for future in pending:
+                    future.cancel()
+                logging.info('Interrupted, continue with --analyze_resume')
+
+    duration = time() - start_time
+    logging.info('Analyzed %d frames with %d faces in %.f s (%.f fps)' % (
+        num_frames, num_faces, duration, num_frames / max(duration, 1e-9)))
+
+
+if __name__ == '__main__':
+    app.run(main)
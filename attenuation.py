@@ -0,0 +1,199 @@
+import numpy as np
+
+# The typical width of a face in meters and the horizontal field of view of
+# the Lepton 3.5 in degrees, to estimate distance from the face size.
+FACE_WIDTH = 0.15
+HORIZONTAL_FOV = 57
+
+# The coefficients of the atmospheric transmission in the long-wave infrared
+# as used by FLIR: two exponentials over the square root of distance in
+# meters and of the water vapor content.
+TRANSMISSION_X = 1.9
+TRANSMISSION_ALPHAS = (0.006569, 0.01262)
+TRANSMISSION_BETAS = (-0.002276, -0.00667)
+
+# The standard pressure in hPa, which the transmission coefficients assume.
+STANDARD_PRESSURE = 1013.25
+
+# The spectral band of the Lepton in meters, and the Planck constant, the
+# speed of light and the Boltzmann constant in SI units.
+WAVELENGTHS = np.linspace(8e-6, 14e-6, 61)
+PLANCK = 6.62607015e-34
+LIGHT_SPEED = 2.99792458e8
+BOLTZMANN = 1.380649e-23
+
+# The temperatures in kelvin to invert the band radiance on.
+RADIANCE_TEMPERATURES = np.linspace(173.15, 373.15, 2001)
+
+# The grid of the correction table: the face width as a fraction of the image
+# width, the ambient temperature in °C, the pressure in hPa, the relative
+# humidity in % and the observed temperature in centikelvin. Loaded tables
+# need to have the same axes, in the same order.
+TABLE_AXES = (
+    ('face_fraction', np.geomspace(0.02, 0.8, 24)),
+    ('ambient_temperature', np.linspace(0, 40, 9)),
+    ('pressure', np.linspace(900, 1100, 3)),
+    ('humidity', np.linspace(0, 100, 6)),
+    ('observed_temperature', np.linspace(29315, 31815, 11)),
+)
+
+# The face statistics which are temperatures, see measure.py.
+TEMPERATURE_STATISTICS = ('max', 'percentile', 'mean')
+
+
+def face_distance(face_fraction):
+    # Estimate the distance in meters from the width of the face relative to
+    # the image width, with a pinhole camera model.
+    return FACE_WIDTH / (2 * np.tan(np.radians(HORIZONTAL_FOV / 2)) *
+                         face_fraction)
+
+
+def transmission(distance, ambient_temperature, pressure, humidity):
+    # The fraction of radiation which makes it through the air. The absorbing
+    # water vapor scales with the relative humidity and the pressure.
+    temperature = ambient_temperature
+    water_vapor = humidity / 100 * np.exp(
+        1.5587 + 0.06939 * temperature - 0.00027816 * temperature ** 2 +
+        0.00000068455 * temperature ** 3)
+    path = np.sqrt(distance * pressure / STANDARD_PRESSURE)
+    (alpha1, alpha2), (beta1, beta2) = TRANSMISSION_ALPHAS, TRANSMISSION_BETAS
+    return (TRANSMISSION_X * np.exp(-path * (alpha1 + beta1 *
+                                             np.sqrt(water_vapor))) +
+            (1 - TRANSMISSION_X) * np.exp(-path * (alpha2 + beta2 *
+                                                   np.sqrt(water_vapor))))
+
+
+def band_radiance(temperature):
+    # The black body radiance at temperatures in kelvin, integrated over the
+    # band of the camera with the trapezoidal rule.
+    temperature = np.asarray(temperature, dtype=np.float64)[..., np.newaxis]
+    spectral = (2 * PLANCK * LIGHT_SPEED ** 2 / WAVELENGTHS ** 5 /
+                np.expm1(PLANCK * LIGHT_SPEED /
+                         (WAVELENGTHS * BOLTZMANN * temperature)))
+    return ((spectral.sum(axis=-1) -
+             (spectral[..., 0] + spectral[..., -1]) / 2) *
+            (WAVELENGTHS[1] - WAVELENGTHS[0]))
+
+
+def attenuation_offset(face_fraction, ambient_temperature, pressure, humidity,
+                       observed_temperature):
+    # The correction in centikelvin to add to an observed temperature. The
+    # camera sees the face's radiance attenuated by the air plus the air's
+    # own radiance. The band radiance has no closed form inverse, so it is
+    # interpolated.
+    tau = transmission(face_distance(face_fraction), ambient_temperature,
+                       pressure, humidity)
+    observed = observed_temperature / 100
+    radiance = ((band_radiance(observed) -
+                 (1 - tau) * band_radiance(ambient_temperature + 273.15)) /
+                tau)
+    corrected = np.interp(radiance, band_radiance(RADIANCE_TEMPERATURES),
+                          RADIANCE_TEMPERATURES)
+    return (corrected - observed) * 100
+
+
+# Multilinear interpolation in a table of values on a regular grid, e.g. of
+# corrections precomputed from an expensive model. Looking up many points at
+# once costs a few array operations per dimension, independent of the model.
+class CorrectionTable(object):
+    def __init__(self, axes, values):
+        # The axes are (name, ascending coordinates) pairs, one per dimension
+        # of the values.
+        self.names = [name for name, _ in axes]
+        self.axes = [np.asarray(coordinates, dtype=np.float64)
+                     for _, coordinates in axes]
+        self.values = np.asarray(values, dtype=np.float32)
+        assert self.values.shape == tuple(len(axis) for axis in self.axes)
+        assert all(len(axis) > 1 for axis in self.axes)
+
+        # The offsets of all corners of a grid cell, e.g. of the 32 corners in
+        # five dimensions, as bits per dimension and into the flat values.
+        dimensions = len(self.axes)
+        self._corners = (np.arange(2 ** dimensions)[:, np.newaxis] >>
+                         np.arange(dimensions)) & 1
+        self._strides = np.array(self.values.strides) // self.values.itemsize
+        self._corner_offsets = self._corners @ self._strides
+        self._flat_values = self.values.ravel()
+
+    @classmethod
+    def compute(cls, function, axes):
+        # Evaluate a vectorized function on all points of the grid.
+        grid = np.meshgrid(*[coordinates for _, coordinates in axes],
+                           indexing='ij')
+        return cls(axes, function(*grid))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            names = [str(name) for name in data['names']]
+            return cls([(name, data['axis_' + name]) for name in names],
+                       data['values'])
+
+    def save(self, path):
+        np.savez(path, names=np.array(self.names), values=self.values,
+                 **{'axis_' + name: axis
+                    for name, axis in zip(self.names, self.axes)})
+
+    def lookup(self, points):
+        # Interpolate the values at points of shape (n, dimensions), which
+        # are clipped to the grid.
+        points = np.atleast_2d(np.asarray(points, dtype=np.float64))
+        lower = np.empty(points.shape, dtype=np.intp)
+        fractions = np.empty(points.shape)
+        for dimension, axis in enumerate(self.axes):
+            coordinates = np.clip(points[:, dimension], axis[0], axis[-1])
+            lower[:, dimension] = np.clip(
+                np.searchsorted(axis, coordinates) - 1, 0, len(axis) - 2)
+            below = axis[lower[:, dimension]]
+            fractions[:, dimension] = ((coordinates - below) /
+                                       (axis[lower[:, dimension] + 1] - below))
+
+        # Sum the weighted values at all corners of the enclosing cells, with
+        # the weights of shape (points, corners).
+        weights = np.where(self._corners, fractions[:, np.newaxis],
+                           1 - fractions[:, np.newaxis]).prod(axis=2)
+        indices = (lower @ self._strides)[:, np.newaxis] + self._corner_offsets
+        return (weights * self._flat_values[indices]).sum(axis=1)
+
+
+def attenuation_table(path=None):
+    # Load the attenuation correction table, or compute it and save it to the
+    # path if there is no such file yet.
+    if path:
+        try:
+            table = CorrectionTable.load(path)
+        except FileNotFoundError:
+            pass
+        else:
+            names = [name for name, _ in TABLE_AXES]
+            if table.names != names:
+                raise ValueError('Expected attenuation table axes %s, got %s'
+                                 % (names, table.names))
+            return table
+    table = CorrectionTable.compute(attenuation_offset, TABLE_AXES)
+    if path:
+        table.save(path)
+    return table
+
+
+def correct_face_stats(table, face_stats, bboxes, image_width, ambient):
+    # Correct the temperature statistics of all faces in place with a single
+    # lookup, given their [[left, top], [right, bottom]] bounding boxes and
+    # the AmbientData. Faces with empty crops are left alone.
+    measured = face_stats['pixels'] > 0
+    if not np.any(measured):
+        return face_stats
+    boxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)[measured]
+    observed = np.stack([face_stats[name][measured]
+                         for name in TEMPERATURE_STATISTICS], axis=1)
+
+    points = np.empty((observed.size, len(TABLE_AXES)))
+    points[:, 0] = np.repeat((boxes[:, 2] - boxes[:, 0]) / image_width,
+                             len(TEMPERATURE_STATISTICS))
+    points[:, 1:4] = (ambient.temperature, ambient.pressure, ambient.humidity)
+    points[:, 4] = observed.ravel()
+    corrected = observed + table.lookup(points).reshape(observed.shape)
+
+    for index, name in enumerate(TEMPERATURE_STATISTICS):
+        face_stats[name][measured] = corrected[:, index]
+    return face_stats
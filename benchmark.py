@@ -0,0 +1,313 @@
+from absl import app
+from absl import flags
+from absl import logging
+from aggregate import TemperatureAggregator
+from ambient import AmbientData
+from attenuation import attenuation_table
+from attenuation import correct_face_stats
+import cv2
+from fever import detect
+from fever import draw
+from fever import format_temperature
+from fever import Frame
+from fever import measure
+from fever import open_detector
+from fever import preprocess
+from fever import StreamMetrics
+from fever import WINDOW_HEIGHT
+from fever import WINDOW_WIDTH
+from framesource import DEFAULT_FPS
+from framestack import FrameStack
+import json
+from measure import measure_faces
+from metrics import Registry
+import numpy as np
+import platform
+from preprocess import Preprocessor
+from presence import PresenceGate
+from renderer import Renderer
+from time import perf_counter
+import tracemalloc
+from tracker import FaceTracker
+
+FLAGS = flags.FLAGS
+
+STAGES = ['preprocess', 'colormap', 'resize', 'presence', 'detect',
+          'temporal', 'measure', 'attenuation', 'overlay', 'end_to_end']
+
+flags.DEFINE_integer('benchmark_frames', 1000, 'The number of synthetic '
+                     'frames to time each stage on.')
+flags.DEFINE_integer('benchmark_warmup', 10, 'The number of frames to run '
+                     'each stage on before timing it.')
+flags.DEFINE_integer('benchmark_allocation_frames', 100, 'The number of '
+                     'frames to trace memory allocations on, separately from '
+                     'timing.')
+flags.DEFINE_integer('benchmark_width', 160, 'The width of the synthetic '
+                     'frames, by default the Lepton 3.5 resolution.')
+flags.DEFINE_integer('benchmark_height', 120, 'The height of the synthetic '
+                     'frames.')
+flags.DEFINE_integer('benchmark_faces', 2, 'The number of warm faces in the '
+                     'synthetic frames.')
+flags.DEFINE_integer('benchmark_seed', 0, 'The random seed for the synthetic '
+                     'frames.')
+flags.DEFINE_list('benchmark_stages', STAGES, 'The stages to benchmark.')
+flags.DEFINE_string('benchmark_output', None, 'A file to write the results '
+                    'to as JSON. Defaults to stdout.')
+flags.DEFINE_string('benchmark_save_frames', None, 'A .npy file to save the '
+                    'synthetic frames to, e.g. to replay them.')
+
+# The synthetic scene in centikelvin: a room at 22 °C and faces at 34 °C which
+# are up to 2 °C warmer at the center.
+AMBIENT_TEMPERATURE = 29515
+FACE_TEMPERATURE = 30715
+FACE_PEAK = 200
+NOISE = 10
+
+# The synthetic ambient conditions, in °C, hPa, and %.
+AMBIENT = AmbientData(0, 22, 1013.25, 50)
+
+
+def synthetic_frames(num_frames, width, height, num_faces, seed=0):
+    # Returns frames of shape (frames, height, width) with warm elliptic faces
+    # bouncing around, and the [[left, top], [right, bottom]] bounding boxes
+    # of the faces in each frame.
+    random = np.random.default_rng(seed)
+    rows, columns = np.mgrid[0:height, 0:width]
+
+    # A slight vertical gradient, like a warmer ceiling.
+    background = AMBIENT_TEMPERATURE + 100 * (1 - rows / height)
+
+    face_widths = random.uniform(0.1, 0.25, num_faces) * width
+    face_sizes = np.stack([face_widths, 1.3 * face_widths], axis=1)
+    positions = random.uniform(0, 1, (num_faces, 2)) * (
+        (width, height) - face_sizes)
+    velocities = random.uniform(-2, 2, (num_faces, 2))
+
+    frames = np.empty((num_frames, height, width), dtype=np.uint16)
+    bboxes = np.empty((num_frames, num_faces, 2, 2))
+    for index in range(num_frames):
+        frame = background + random.normal(0, NOISE, (height, width))
+        for position, size in zip(positions, face_sizes):
+            center = position + size / 2
+            radius = (((columns - center[0]) / (size[0] / 2)) ** 2 +
+                      ((rows - center[1]) / (size[1] / 2)) ** 2)
+            face = radius < 1
+            frame[face] = (FACE_TEMPERATURE + FACE_PEAK * (1 - radius[face]) +
+                           random.normal(0, NOISE, np.count_nonzero(face)))
+        frames[index] = frame
+        bboxes[index, :, 0] = positions
+        bboxes[index, :, 1] = positions + face_sizes
+
+        # Move the faces and bounce them off the edges.
+        positions += velocities
+        bounced = (positions < 0) | (positions > (width, height) - face_sizes)
+        velocities[bounced] *= -1
+        np.clip(positions, 0, (width, height) - face_sizes, out=positions)
+
+    return frames, bboxes
+
+
+def time_stage(function, num_frames, setup=None):
+    # Returns the latency of each call in seconds. The optional setup runs
+    # before each call and isn't timed.
+    for index in range(FLAGS.benchmark_warmup):
+        if setup:
+            setup(index)
+        function(index)
+
+    latencies = np.empty(num_frames)
+    for index in range(num_frames):
+        if setup:
+            setup(index)
+        start_time = perf_counter()
+        function(index)
+        latencies[index] = perf_counter() - start_time
+    return latencies
+
+
+def trace_allocations(function, num_frames, setup=None):
+    # Returns the mean peak of memory allocated during one call and the mean
+    # memory retained after it, both in bytes. This covers Python objects and
+    # NumPy arrays, but not the native allocations of OpenCV.
+    allocated = np.empty(num_frames)
+    retained = np.empty(num_frames)
+    tracemalloc.start()
+    try:
+        for index in range(num_frames):
+            if setup:
+                setup(index)
+            baseline, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            function(index)
+            current, peak = tracemalloc.get_traced_memory()
+            allocated[index] = peak - baseline
+            retained[index] = current - baseline
+    finally:
+        tracemalloc.stop()
+    return allocated.mean(), retained.mean()
+
+
+def summarize(latencies, allocated, retained):
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+    return {
+        'p50_ms': p50,
+        'p95_ms': p95,
+        'p99_ms': p99,
+        'mean_ms': latencies.mean() * 1000,
+        'fps': 1 / latencies.mean(),
+        'allocated_bytes_per_frame': allocated,
+        'retained_bytes_per_frame': retained,
+    }
+
+
+def stage_functions(frames, bboxes):
+    # Returns each stage's function and optional setup, both taking the index
+    # of the frame.
+    num_frames, height, width = frames.shape
+    preprocessor = Preprocessor((height, width), FLAGS.min_temperature,
+                                FLAGS.max_temperature)
+    renderer = Renderer((height, width), WINDOW_WIDTH, WINDOW_HEIGHT,
+                        quality=FLAGS.render_quality,
+                        min_temperature=FLAGS.min_temperature,
+                        max_temperature=FLAGS.max_temperature)
+    face_detector = open_detector()
+    frame_stack = FrameStack((height, width), max(FLAGS.temporal_frames, 2))
+    presence_gate = PresenceGate(
+        (height, width), FLAGS.min_temperature, FLAGS.max_temperature,
+        min_pixels=FLAGS.presence_min_pixels,
+        threshold=FLAGS.presence_threshold,
+        background_rate=FLAGS.presence_background_rate,
+        hold_frames=FLAGS.presence_hold)
+
+    def frame_index(index):
+        return index % num_frames
+
+    def acquire(index):
+        np.copyto(dst=preprocessor.raw(0), src=frames[frame_index(index)])
+
+    def acquire_and_preprocess(index):
+        acquire(index)
+        preprocessor.process(0)
+
+    def acquire_and_colorize(index):
+        acquire_and_preprocess(index)
+        renderer.colorize(preprocessor.scaled(0))
+
+    def measure_stage(index):
+        return measure_faces(frames[frame_index(index)],
+                             bboxes[frame_index(index)],
+                             percentile=FLAGS.temperature_percentile,
+                             inner_fraction=FLAGS.inner_face_fraction)
+
+    # Drawing the overlay reuses the face statistics of the setup.
+    face_stats = []
+
+    def measure_and_resize(index):
+        face_stats[:] = measure_stage(index)
+        renderer.resize()
+
+    # Correcting the attenuation reuses the face statistics of the setup.
+    correction_table = attenuation_table()
+    uncorrected_stats = []
+
+    def measure_only(index):
+        uncorrected_stats[:] = [measure_stage(index)]
+
+    def attenuation(index):
+        correct_face_stats(correction_table, uncorrected_stats[0],
+                           bboxes[frame_index(index)], width, AMBIENT)
+
+    def overlay(index):
+        for bbox, stats in zip(bboxes[frame_index(index)], face_stats):
+            renderer.draw_face(bbox, format_temperature(
+                stats[FLAGS.temperature_statistic], add_unit=False))
+
+    # The end to end benchmark runs the stages of fever.py in sequence,
+    # including their metrics.
+    stream_metrics = StreamMetrics(Registry())
+    tracker = FaceTracker(detect_interval=FLAGS.detect_interval,
+                          iou_threshold=FLAGS.track_iou_threshold,
+                          min_confidence=FLAGS.track_min_confidence)
+    aggregator = TemperatureAggregator(min_samples=FLAGS.reading_samples,
+                                       max_people=FLAGS.max_tracked_people,
+                                       quantile=FLAGS.reading_quantile)
+
+    def end_to_end(index):
+        frame = Frame(index, index / DEFAULT_FPS, 0, preprocessor,
+                      stream_metrics)
+        np.copyto(dst=frame.raw, src=frames[frame_index(index)])
+        preprocess(frame)
+        if FLAGS.detect:
+            detect(frame, face_detector, tracker,
+                   presence_gate if FLAGS.presence_gate else None)
+            measure(frame, aggregator)
+        with frame.metrics.render.time():
+            draw(frame, renderer)
+
+    return {
+        'preprocess': (lambda index: preprocessor.process(0), acquire),
+        'colormap': (lambda index: renderer.colorize(preprocessor.scaled(0)),
+                     acquire_and_preprocess),
+        'resize': (lambda index: renderer.resize(), acquire_and_colorize),
+        'temporal': (lambda index: (frame_stack.push(
+            frames[frame_index(index)]), frame_stack.mean()), None),
+        'presence': (lambda index: presence_gate.update(
+            frames[frame_index(index)]), None),
+        'detect': (lambda index: face_detector.detect(
+            preprocessor.scaled(0), FLAGS.face_confidence,
+            FLAGS.max_num_faces), acquire_and_preprocess),
+        'measure': (measure_stage, None),
+        'attenuation': (attenuation, measure_only),
+        'overlay': (overlay, measure_and_resize),
+        'end_to_end': (end_to_end, None),
+    }
+
+
+def main(_):
+    for stage in FLAGS.benchmark_stages:
+        if stage not in STAGES:
+            raise app.UsageError('Unknown stage: %s' % stage)
+
+    logging.info('Generating %d synthetic frames' % FLAGS.benchmark_frames)
+    frames, bboxes = synthetic_frames(
+        FLAGS.benchmark_frames, FLAGS.benchmark_width,
+        FLAGS.benchmark_height, FLAGS.benchmark_faces,
+        seed=FLAGS.benchmark_seed)
+    if FLAGS.benchmark_save_frames:
+        np.save(FLAGS.benchmark_save_frames, frames)
+
+    functions = stage_functions(frames, bboxes)
+    results = {}
+    for stage in FLAGS.benchmark_stages:
+        function, setup = functions[stage]
+        latencies = time_stage(function, FLAGS.benchmark_frames, setup)
+        allocated, retained = trace_allocations(
+            function, FLAGS.benchmark_allocation_frames, setup)
+        results[stage] = summarize(latencies, allocated, retained)
+        logging.info('%s: %.3f ms p50, %.3f ms p99' % (
+            stage, results[stage]['p50_ms'], results[stage]['p99_ms']))
+
+    report = json.dumps({
+        'frames': FLAGS.benchmark_frames,
+        'width': FLAGS.benchmark_width,
+        'height': FLAGS.benchmark_height,
+        'faces': FLAGS.benchmark_faces,
+        'detector': FLAGS.detector,
+        'render_quality': FLAGS.render_quality,
+        'machine': platform.machine(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'stages': results,
+    }, indent=2)
+    if FLAGS.benchmark_output:
+        with open(FLAGS.benchmark_output, 'w') as output_file:
+            output_file.write(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    # Benchmark without hardware by default.
+    FLAGS.set_default('detector', 'stub')
+    app.run(main)
@@ -0,0 +1,261 @@
+from contextlib import nullcontext
+from framesource import FrameReadLock
+from framesource import FrameSource
+import multiprocessing
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+from recording import Recorder
+from signal import SIG_IGN
+from signal import signal
+from signal import SIGINT
+from time import monotonic
+from time import sleep
+
+# How often the capture process checks whether it was stopped.
+POLL_INTERVAL = 0.1
+
+# How long to wait for the camera in the capture process to start streaming.
+STARTUP_TIMEOUT = 10
+
+# How long to wait for the capture process to exit, before terminating it and
+# after.
+STOP_TIMEOUT = 5
+
+
+# A ring of frames in shared memory. Frame N goes into slot N modulo the
+# number of slots, and each slot records the ID of the frame in it (or -1
+# while it's being written), so that readers can detect overwritten frames
+# without locking.
+class SharedFrameRing(object):
+    def __init__(self, shared_memory, width, height, num_slots):
+        buffer = shared_memory.buf
+        offset = 0
+        self.latest_id = np.ndarray((1,), dtype=np.int64, buffer=buffer,
+                                    offset=offset)
+        offset += self.latest_id.nbytes
+        self.slot_ids = np.ndarray((num_slots,), dtype=np.int64,
+                                   buffer=buffer, offset=offset)
+        offset += self.slot_ids.nbytes
+        self.timestamps = np.ndarray((num_slots,), dtype=np.float64,
+                                     buffer=buffer, offset=offset)
+        offset += self.timestamps.nbytes
+        self.frames = np.ndarray((num_slots, height, width), dtype=np.uint16,
+                                 buffer=buffer, offset=offset)
+
+    @staticmethod
+    def size(width, height, num_slots):
+        return 8 + num_slots * (8 + 8 + 2 * width * height)
+
+    def write(self, frame_id, frame, timestamp):
+        slot = frame_id % len(self.slot_ids)
+        self.slot_ids[slot] = -1
+        np.copyto(dst=self.frames[slot], src=frame)
+        self.timestamps[slot] = timestamp
+        self.slot_ids[slot] = frame_id
+        self.latest_id[0] = frame_id
+
+    def close(self):
+        # Release all views into the shared memory before closing it.
+        del self.latest_id
+        del self.slot_ids
+        del self.timestamps
+        del self.frames
+
+
+def capture_frames(connection, stop_event, condition, num_slots, record_path,
+                   device):
+    # The main process stops capture, also on SIGINT.
+    signal(SIGINT, SIG_IGN)
+    try:
+        # Runs in the capture process. Only load the UVC library here.
+        from purethermal import PureThermal
+
+        recorder = Recorder(record_path) if record_path else None
+        with recorder or nullcontext(), PureThermal(
+                recorder=recorder, **device) as camera:
+            connection.send((camera.width(), camera.height()))
+            shared_memory = SharedMemory(name=connection.recv())
+            ring = SharedFrameRing(shared_memory, camera.width(),
+                                   camera.height(), num_slots)
+            try:
+                while not stop_event.is_set():
+                    if not camera.wait_for_new_frame(timeout=POLL_INTERVAL):
+                        continue
+                    with camera.frame_lock():
+                        ring.write(camera.frame_id(), camera.frame(),
+                                   camera.frame_timestamp())
+                    with condition:
+                        condition.notify_all()
+            finally:
+                ring.close()
+                shared_memory.close()
+    except Exception as error:
+        connection.send(error)
+        raise
+
+
+# Streams frames from a PureThermal camera in a dedicated capture process and
+# reads them from shared memory, which keeps USB capture off the GIL of the
+# main process. The device is selected by the keyword arguments of
+# PureThermal, e.g. its serial number.
+class CaptureProcessFrameSource(FrameSource):
+    def __init__(self, num_slots=8, record_path=None, device=None):
+        self._num_slots = num_slots
+        self._record_path = record_path
+        self._device = device or {}
+
+    def __enter__(self):
+        context = multiprocessing.get_context('spawn')
+        self._connection, child_connection = context.Pipe()
+        self._stop_event = context.Event()
+        self._condition = context.Condition()
+        self._process = context.Process(
+            target=capture_frames, name='capture', daemon=True,
+            args=(child_connection, self._stop_event, self._condition,
+                  self._num_slots, self._record_path, self._device))
+        self._process.start()
+
+        # Allocate shared memory once the frame size is negotiated. The
+        # capture process may be stuck starting the camera or waiting for the
+        # shared memory, so it is terminated on failure.
+        if self._connection.poll(STARTUP_TIMEOUT):
+            try:
+                message = self._connection.recv()
+            except EOFError:
+                message = RuntimeError('exited')
+        else:
+            message = RuntimeError('timed out after %d s' % STARTUP_TIMEOUT)
+        if isinstance(message, Exception):
+            self._terminate()
+            raise RuntimeError('Capture process failed: %s' % message)
+        self._frame_width, self._frame_height = message
+        self._shared_memory = SharedMemory(create=True, size=(
+            SharedFrameRing.size(self._frame_width, self._frame_height,
+                                 self._num_slots)))
+        self._ring = SharedFrameRing(self._shared_memory, self._frame_width,
+                                     self._frame_height, self._num_slots)
+        self._connection.send(self._shared_memory.name)
+
+        # Pinned frames are copied out of the ring, since the capture process
+        # doesn't wait for readers.
+        self._frame = np.zeros((self._frame_height, self._frame_width),
+                               dtype=np.uint16)
+        self._timestamp = None
+        self._pinned = False
+        self._read_id = 0
+        self._dropped_frames = 0
+        self._duplicated_frames = 0
+        self._torn_frames = 0
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._stop()
+        self._ring.close()
+        self._shared_memory.close()
+        self._shared_memory.unlink()
+
+    def frame(self):
+        assert self._pinned
+        return self._frame
+
+    def frame_lock(self):
+        return FrameReadLock(self)
+
+    def frame_id(self):
+        return self._read_id
+
+    def frame_timestamp(self):
+        assert self._pinned
+        return self._timestamp
+
+    def wait_for_new_frame(self, timeout=None):
+        # Wait in short intervals, since a capture process which died doesn't
+        # notify anymore.
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            if deadline is None:
+                wait_time = POLL_INTERVAL
+            else:
+                wait_time = min(max(deadline - monotonic(), 0), POLL_INTERVAL)
+            with self._condition:
+                if self._condition.wait_for(
+                        lambda: self._ring.latest_id[0] != self._read_id,
+                        wait_time):
+                    return True
+            self._check_process()
+            if deadline is not None and monotonic() >= deadline:
+                return False
+
+    def dropped_frames(self):
+        return self._dropped_frames
+
+    def duplicated_frames(self):
+        return self._duplicated_frames
+
+    def torn_frames(self):
+        return self._torn_frames
+
+    def width(self):
+        return self._frame_width
+
+    def height(self):
+        return self._frame_height
+
+    def _pin(self):
+        # Frames aren't locked across processes, so copy the latest frame and
+        # check by its ID whether it was overwritten during the copy. A torn
+        # frame is discarded and the then latest frame copied instead. The
+        # capture process wraps around the ring only after num_slots frames,
+        # which takes far longer than copying one.
+        while True:
+            frame_id = int(self._ring.latest_id[0])
+            slot = frame_id % self._num_slots
+            if self._ring.slot_ids[slot] != frame_id:
+                # The frame is being overwritten. Let the capture process
+                # finish it, unless it died while writing.
+                self._check_process()
+                sleep(0)
+                continue
+            np.copyto(dst=self._frame, src=self._ring.frames[slot])
+            timestamp = float(self._ring.timestamps[slot])
+            if self._ring.slot_ids[slot] == frame_id:
+                break
+            self._torn_frames += 1
+        if frame_id == self._read_id:
+            self._duplicated_frames += 1
+        elif self._read_id:
+            self._dropped_frames += max(frame_id - self._read_id - 1, 0)
+        self._read_id = frame_id
+        self._timestamp = timestamp
+        self._pinned = True
+
+    def _unpin(self):
+        self._pinned = False
+
+    def _check_process(self):
+        if self._process.exitcode is None:
+            return
+        # The capture process sends errors before it exits, if it can.
+        message = None
+        try:
+            if self._connection.poll():
+                message = self._connection.recv()
+        except EOFError:
+            pass
+        if isinstance(message, Exception):
+            raise RuntimeError('Capture process failed: %s' % message)
+        raise RuntimeError('Capture process exited with code %d'
+                           % self._process.exitcode)
+
+    def _stop(self):
+        self._stop_event.set()
+        self._process.join(STOP_TIMEOUT)
+        if self._process.is_alive():
+            self._terminate()
+
+    def _terminate(self):
+        self._process.terminate()
+        self._process.join(STOP_TIMEOUT)
+        if self._process.is_alive():
+            self._process.kill()
+            self._process.join()
@@ -0,0 +1,175 @@
+from collections import namedtuple
+import cv2
+import json
+import numpy as np
+from time import sleep
+
+# A detected face like the DetectionCandidate of the Edge TPU API, with a
+# [[left, top], [right, bottom]] bounding box in pixels of the input image.
+Face = namedtuple('Face', ['bounding_box', 'score'])
+
+
+# Fills a preallocated model input tensor from 8-bit grayscale images in one
+# step, resizing while keeping the aspect ratio and padding the bottom and
+# right. Tensors of other types, e.g. of float models, get the same 0 to 255
+# pixel values. Also maps bounding boxes relative to the tensor back to pixels
+# of the image.
+class Letterbox(object):
+    def __init__(self, image_shape, tensor_shape, dtype=np.uint8):
+        image_height, image_width = image_shape
+        self._tensor_height, self._tensor_width = tensor_shape
+        self._scale = min(self._tensor_width / image_width,
+                          self._tensor_height / image_height)
+        self._resized_size = (int(image_width * self._scale),
+                              int(image_height * self._scale))
+        self.tensor = np.zeros((*tensor_shape, 3), dtype=dtype)
+        # OpenCV only resizes into a destination of the source type.
+        self._resized = np.zeros(self._resized_size[::-1], dtype=np.uint8)
+        self._region = self.tensor[:self._resized_size[1],
+                                   :self._resized_size[0]]
+
+    def fill(self, image):
+        # Broadcasting the resized image to all channels also converts it
+        # from grayscale to RGB, and to the type of the tensor.
+        cv2.resize(src=image, dst=self._resized, dsize=self._resized_size,
+                   interpolation=cv2.INTER_LINEAR)
+        np.copyto(dst=self._region, src=self._resized[:, :, np.newaxis],
+                  casting='unsafe')
+        return self.tensor
+
+    def to_pixels(self, bbox):
+        return np.asarray(bbox, dtype=np.float64) * (
+            self._tensor_width, self._tensor_height) / self._scale
+
+
+# The interface shared by all face detection backends. Images are 8-bit
+# grayscale arrays of shape (height, width) and faces are returned with the
+# highest scores first.
+class Detector(object):
+    def detect(self, image, threshold, top_k):
+        raise NotImplementedError()
+
+    def warm_up(self, image_shape):
+        # Runs a dummy inference, so that one-time costs like uploading the
+        # model to the accelerator and allocating buffers for the image size
+        # are paid before the first frame.
+        self.detect(np.zeros(image_shape, dtype=np.uint8), 1, 1)
+
+    def detect_batch(self, images, threshold, top_k):
+        # Detects faces in several images, e.g. from multiple cameras. Neither
+        # accelerator API has batched inference, so by default the images run
+        # back to back.
+        return [self.detect(image, threshold, top_k) for image in images]
+
+
+# Runs a model compiled for the Edge TPU on the Coral USB Accelerator. Images
+# are passed as raw input tensors, bypassing the PIL-based preprocessing of the
+# Edge TPU API.
+class EdgeTpuDetector(Detector):
+    def __init__(self, model_path):
+        # Only load the Edge TPU library when it's actually used.
+        from edgetpu.detection.engine import DetectionEngine
+        self._engine = DetectionEngine(model_path)
+        _, self._input_height, self._input_width, _ = (
+            self._engine.get_input_tensor_shape())
+        self._letterbox = None
+
+    def detect(self, image, threshold, top_k):
+        if not self._letterbox or self._letterbox_shape != image.shape:
+            self._letterbox = Letterbox(
+                image.shape, (self._input_height, self._input_width))
+            self._letterbox_shape = image.shape
+
+        # The engine expects a flat tensor and returns relative coordinates.
+        input_tensor = self._letterbox.fill(image).reshape(-1)
+        candidates = self._engine.detect_with_input_tensor(
+            input_tensor, threshold=threshold, top_k=top_k)
+        return [Face(self._letterbox.to_pixels(candidate.bounding_box),
+                     candidate.score) for candidate in candidates]
+
+
+# Runs a regular TF Lite model on the CPU, for units without an accelerator.
+# The default delegates apply, e.g. XNNPACK in recent versions of TF Lite.
+class TfliteDetector(Detector):
+    def __init__(self, model_path, num_threads=None):
+        # Only load the TF Lite runtime when it's actually used.
+        from tflite_runtime.interpreter import Interpreter
+        self._interpreter = Interpreter(model_path, num_threads=num_threads)
+        self._interpreter.allocate_tensors()
+
+        input_details = self._interpreter.get_input_details()[0]
+        _, self._input_height, self._input_width, _ = input_details['shape']
+        self._input_index = input_details['index']
+        self._input_dtype = input_details['dtype']
+        self._letterbox = None
+
+        # The outputs of the SSD post-processing op, in order.
+        self._output_indices = [
+            output['index'] for output in
+            self._interpreter.get_output_details()]
+
+    def detect(self, image, threshold, top_k):
+        if not self._letterbox or self._letterbox_shape != image.shape:
+            self._letterbox = Letterbox(
+                image.shape, (self._input_height, self._input_width),
+                dtype=self._input_dtype)
+            self._letterbox_shape = image.shape
+
+        input_tensor = self._letterbox.fill(image)
+        self._interpreter.set_tensor(self._input_index,
+                                     input_tensor[np.newaxis])
+        self._interpreter.invoke()
+        boxes, _, scores, count = [
+            self._interpreter.get_tensor(index)
+            for index in self._output_indices]
+
+        # Map the relative (ymin, xmin, ymax, xmax) boxes back to pixels.
+        faces = []
+        for box, score in zip(boxes[0, :int(count[0])], scores[0]):
+            if score < threshold:
+                continue
+            bbox = self._letterbox.to_pixels([[box[1], box[0]],
+                                              [box[3], box[2]]])
+            faces.append(Face(bbox, float(score)))
+        faces.sort(key=lambda face: face.score, reverse=True)
+        return faces[:top_k]
+
+
+# Returns scripted faces without running a model, e.g. to measure everything
+# but the inference. The script is a JSON list with the faces returned by
+# consecutive calls to detect(), each as [left, top, right, bottom, score],
+# and repeats. Since tracking and the presence gate skip detection on some
+# frames, entries don't correspond to frames. Without a script, there is a
+# single face in the center of every frame. An optional latency simulates the
+# inference time in seconds.
+class StubDetector(Detector):
+    def __init__(self, script_path=None, latency=0):
+        if script_path:
+            with open(script_path) as script_file:
+                self._script = json.load(script_file)
+        else:
+            self._script = None
+        self._latency = latency
+        self._index = 0
+
+    def warm_up(self, image_shape):
+        # There is no model, and warming up would advance the script.
+        pass
+
+    def detect(self, image, threshold, top_k):
+        if self._latency:
+            sleep(self._latency)
+
+        if self._script is None:
+            height, width = image.shape
+            return [Face(np.array([[width / 3, height / 3],
+                                   [2 * width / 3, 2 * height / 3]]), 1.0)]
+
+        frame_faces = self._script[self._index % len(self._script)]
+        self._index += 1
+        faces = [Face(np.array([[left, top], [right, bottom]],
+                               dtype=np.float64), score)
+                 for left, top, right, bottom, score in frame_faces
+                 if score >= threshold]
+        faces.sort(key=lambda face: face.score, reverse=True)
+        return faces[:top_k]
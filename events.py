@@ -0,0 +1,213 @@
+from absl import logging
+from collections import namedtuple
+import json
+import os
+from queue import Empty
+from queue import Full
+from queue import Queue
+from threading import Lock
+from threading import Thread
+from time import monotonic
+
+EVENT_FORMATS = ['jsonl', 'sqlite']
+
+# How often to check whether the writer thread is still alive while waiting
+# for room in the queue to stop it.
+POLL_INTERVAL = 0.1
+
+# A single face measurement: the [[left, top], [right, bottom]] bounding box,
+# the temperature statistics in centikelvin from measure.py, and the average
+# AmbientData, if any. Events hold references rather than formatted values,
+# so that creating them is cheap.
+MeasurementEvent = namedtuple('MeasurementEvent', ['timestamp', 'camera',
+                                                   'frame_id', 'track_id',
+                                                   'bbox', 'stats',
+                                                   'ambient'])
+
+# The flat fields of written events, with their SQLite types.
+EVENT_COLUMNS = [('timestamp', 'REAL'),
+                 ('camera', 'INTEGER'),
+                 ('frame_id', 'INTEGER'),
+                 ('track_id', 'INTEGER'),
+                 ('left', 'REAL'),
+                 ('top', 'REAL'),
+                 ('right', 'REAL'),
+                 ('bottom', 'REAL'),
+                 ('max', 'REAL'),
+                 ('percentile', 'REAL'),
+                 ('mean', 'REAL'),
+                 ('pixels', 'INTEGER'),
+                 ('ambient_temperature', 'REAL'),
+                 ('ambient_pressure', 'REAL'),
+                 ('ambient_humidity', 'REAL')]
+
+
+def event_row(event):
+    # Flatten an event into plain Python values in the order of the columns.
+    (left, top), (right, bottom) = event.bbox
+    if event.ambient:
+        ambient = (event.ambient.temperature, event.ambient.pressure,
+                   event.ambient.humidity)
+    else:
+        ambient = (None, None, None)
+    return (event.timestamp, event.camera, event.frame_id, event.track_id,
+            float(left), float(top), float(right), float(bottom),
+            float(event.stats['max']), float(event.stats['percentile']),
+            float(event.stats['mean']), int(event.stats['pixels'])) + ambient
+
+
+# Appends events as JSON lines and rotates the file when it gets too large,
+# keeping a number of backups with numbered suffixes like logging does.
+class JsonlWriter(object):
+    def __init__(self, path, max_bytes=10000000, backup_count=5):
+        self._path = path
+        self._max_bytes = max_bytes
+        self._backup_count = backup_count
+        self._names = [name for name, _ in EVENT_COLUMNS]
+        self._file = None
+
+    def open(self):
+        self._file = open(self._path, 'a')
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def write(self, rows):
+        self._file.write(''.join(json.dumps(dict(zip(self._names, row))) +
+                                 '\n' for row in rows))
+        self._file.flush()
+        if self._max_bytes and self._file.tell() >= self._max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        self._file.close()
+        for index in range(self._backup_count - 1, 0, -1):
+            backup = '%s.%d' % (self._path, index)
+            if os.path.exists(backup):
+                os.replace(backup, '%s.%d' % (self._path, index + 1))
+        if self._backup_count:
+            os.replace(self._path, self._path + '.1')
+            self._file = open(self._path, 'a')
+        else:
+            self._file = open(self._path, 'w')
+
+
+# Inserts events into a SQLite database in write-ahead logging mode, so that
+# it can be queried while events are written. Each batch is one transaction.
+class SqliteWriter(object):
+    def __init__(self, path):
+        self._path = path
+        self._connection = None
+
+    def open(self):
+        # Only load SQLite when it is actually used. The connection is opened
+        # by the caller, but only used by the writer thread.
+        import sqlite3
+
+        self._connection = sqlite3.connect(self._path,
+                                           check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS measurements (%s)' % ', '.join(
+                '"%s" %s' % column for column in EVENT_COLUMNS))
+        self._connection.execute(
+            'CREATE INDEX IF NOT EXISTS measurements_timestamp '
+            'ON measurements (timestamp)')
+        self._insert = 'INSERT INTO measurements VALUES (%s)' % ', '.join(
+            '?' * len(EVENT_COLUMNS))
+
+    def close(self):
+        if self._connection:
+            self._connection.close()
+            self._connection = None
+
+    def write(self, rows):
+        with self._connection:
+            self._connection.executemany(self._insert, rows)
+
+
+# Takes events from the frame processing without blocking it and writes them
+# in batches on a background thread, so that formatting and disk I/O stay out
+# of the frame budget. When the bounded queue is full, events are dropped and
+# counted instead.
+class EventSink(object):
+    def __init__(self, writer, queue_size=1000, batch_size=100,
+                 flush_interval=1):
+        self._writer = writer
+        self._queue = Queue(maxsize=queue_size)
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._dropped = 0
+        self._written = 0
+        self._lock = Lock()
+
+    def __enter__(self):
+        # Open the writer up front, so that e.g. a bad path fails at startup
+        # rather than on the writer thread.
+        self._writer.open()
+        self._thread = Thread(target=self._run, name='events', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        # Write the remaining events before stopping. Don't wait for room in
+        # the queue if the writer thread died.
+        while self._thread.is_alive():
+            try:
+                self._queue.put(None, timeout=POLL_INTERVAL)
+                break
+            except Full:
+                pass
+        self._thread.join()
+
+    def put(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except Full:
+            with self._lock:
+                self._dropped += 1
+
+    def dropped(self):
+        return self._dropped
+
+    def written(self):
+        return self._written
+
+    def _run(self):
+        try:
+            stopped = False
+            while not stopped:
+                batch, stopped = self._next_batch()
+                if not batch:
+                    continue
+                try:
+                    self._writer.write([event_row(event) for event in batch])
+                    self._written += len(batch)
+                except Exception as error:
+                    logging.warning('Failed to write %d events: %s' % (
+                        len(batch), error))
+                    with self._lock:
+                        self._dropped += len(batch)
+        finally:
+            self._writer.close()
+
+    def _next_batch(self):
+        # Collect events until the batch is full or the flush interval since
+        # its first event has passed. Returns the batch and whether the sink
+        # is stopping.
+        batch = []
+        event = self._queue.get()
+        deadline = monotonic() + self._flush_interval
+        while event is not None:
+            batch.append(event)
+            if len(batch) == self._batch_size:
+                return batch, False
+            try:
+                event = self._queue.get(
+                    timeout=max(deadline - monotonic(), 0))
+            except Empty:
+                return batch, False
+        return batch, True
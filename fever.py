@@ -1,15 +1,43 @@
 from absl import app
 from absl import flags
 from absl import logging
-import bme680
-from colormap import TURBO_COLORMAP
+from aggregate import TemperatureAggregator
+from ambient import AmbientSampler
+from ambient import open_bme680
+from attenuation import attenuation_table
+from attenuation import correct_face_stats
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from contextlib import nullcontext
 import cv2
-from edgetpu.detection.engine import DetectionEngine
+from detector import EdgeTpuDetector
+from detector import StubDetector
+from detector import TfliteDetector
+from events import EVENT_FORMATS
+from events import EventSink
+from events import JsonlWriter
+from events import MeasurementEvent
+from events import SqliteWriter
+from framesource import ReplayFrameSource
+from framestack import FrameStack
+from functools import partial
+from liveview import LiveView
+from measure import measure_faces
+from metrics import MetricsServer
+from metrics import Registry
 import numpy as np
-from PIL import Image
-from purethermal import PureThermal
-from smbus2 import SMBus
+import os
+from pipeline import Pipeline
+from pipeline import POLL_INTERVAL
+from preprocess import Preprocessor
+from presence import PresenceGate
+from recording import Recorder
+from renderer import INTERPOLATIONS
+from renderer import Renderer
+from scheduler import DetectionScheduler
+from scheduler import SCHEDULING_POLICIES
 from time import time
+from tracker import FaceTracker
 
 FLAGS = flags.FLAGS
 flags.DEFINE_integer('min_temperature', 29815, 'The minimum expected body '
@@ -20,38 +48,143 @@ flags.DEFINE_string('face_model',
                     'thermal_face_automl_edge_fast_edgetpu.tflite',
                     'The TF Lite face detection model file compiled for Edge '
                     'TPU.')
+flags.DEFINE_enum('detector', 'edgetpu', ['edgetpu', 'cpu', 'stub'],
+                  'The face detection backend: the Edge TPU, TF Lite on the '
+                  'CPU, or a stub with scripted faces.')
+flags.DEFINE_string('cpu_face_model', 'thermal_face_automl_edge_fast.tflite',
+                    'The TF Lite face detection model file for the CPU '
+                    'detector.')
+flags.DEFINE_integer('detector_threads', None, 'The number of threads for the '
+                     'CPU detector. Defaults to what TF Lite chooses.')
+flags.DEFINE_string('stub_faces', None, 'A JSON file with the faces of '
+                    'consecutive detections for the stub detector, each as '
+                    '[left, top, right, bottom, score]. Frames on which '
+                    'detection is skipped don\'t advance it. Defaults to a '
+                    'single face in the center.')
+flags.DEFINE_float('stub_latency', 0, 'The simulated inference time of the '
+                   'stub detector in milliseconds.')
 flags.DEFINE_float('face_confidence', 0.5,
                    'The confidence threshold for face detection.')
 flags.DEFINE_integer('max_num_faces', 10, 'The maximum supported number of '
                      'faces detected per frame.')
+flags.DEFINE_integer('detect_interval', 3, 'Run face detection at least '
+                     'every this many frames and track faces in between.')
+flags.DEFINE_float('track_iou_threshold', 0.3, 'The minimum intersection over '
+                   'union to associate a detected face with a tracked one.')
+flags.DEFINE_float('track_min_confidence', 0.5, 'Run face detection whenever '
+                   'the confidence of any tracked face drops below this.')
+flags.DEFINE_enum('temperature_statistic', 'max',
+                  ['max', 'percentile', 'mean'], 'Which statistic of the '
+                  'temperatures across a face to report.')
+flags.DEFINE_float('temperature_percentile', 95, 'The percentile of the '
+                   'temperatures across a face for the percentile statistic.')
+flags.DEFINE_float('inner_face_fraction', 0.5, 'The fraction of the face '
+                   'bounding box width and height to average over for the '
+                   'mean statistic.')
+flags.DEFINE_integer('reading_samples', 10, 'The number of temperature '
+                     'samples of a person to aggregate before reporting a '
+                     'reading.')
+flags.DEFINE_integer('temporal_frames', 1, 'The number of recent frames to '
+                     'average per pixel before measuring temperatures, which '
+                     'reduces sensor noise.')
+flags.DEFINE_bool('attenuation_correction', False, 'Whether to correct face '
+                  'temperatures for the attenuation by the air between the '
+                  'face and the camera, based on the face size and the '
+                  'ambient sensor readings.')
+flags.DEFINE_string('attenuation_table', None, 'A .npz file to load the '
+                    'attenuation correction table from. If the file doesn\'t '
+                    'exist, the table is computed and saved to it. Defaults '
+                    'to computing the table at startup.')
+flags.DEFINE_float('reading_quantile', 0.9, 'The quantile of the temperature '
+                   'samples of a person to report along with each reading.')
+flags.DEFINE_integer('max_tracked_people', 100, 'The maximum number of people '
+                     'to keep temperature statistics for.')
 flags.DEFINE_bool('display_metric', True, 'Whether to display metric units.')
 flags.DEFINE_bool('detect', True, 'Whether to run face detection.')
+flags.DEFINE_bool('presence_gate', True, 'Whether to skip face detection '
+                  'unless something new in the range of expected body '
+                  'temperatures is in view.')
+flags.DEFINE_integer('presence_min_pixels', 20, 'The number of new warm '
+                     'pixels which indicate presence.')
+flags.DEFINE_integer('presence_threshold', 100, 'How much warmer than the '
+                     'background pixels need to be to count as new, in '
+                     'centikelvin.')
+flags.DEFINE_float('presence_background_rate', 0.05, 'How fast the background '
+                   'model of the presence gate adapts to changes.')
+flags.DEFINE_integer('presence_hold', 9, 'The number of frames to keep '
+                     'detecting faces after the last presence.')
 flags.DEFINE_bool('visualize', False, 'Whether to visualize the thermal '
                   'image.')
+flags.DEFINE_integer('live_view_port', None, 'A port to serve the rendered '
+                     'thermal image on as an MJPEG stream, at / for the first '
+                     'camera and at /1, /2, and so on for further cameras. '
+                     'Works without a display.')
+flags.DEFINE_string('live_view_address', '127.0.0.1', 'The address to serve '
+                    'the live view on. Use 0.0.0.0 to allow remote viewers.')
+flags.DEFINE_integer('live_view_quality', 80, 'The JPEG quality of the live '
+                     'view, from 0 to 100.')
+flags.DEFINE_enum('render_quality', 'best', sorted(INTERPOLATIONS),
+                  'The interpolation quality when resizing the thermal image '
+                  'for the window.')
+flags.DEFINE_bool('normalize_colors', True, 'Whether to min/max normalize the '
+                  'thermal image colors. Otherwise, colors map directly to '
+                  'temperatures.')
+flags.DEFINE_bool('ambient_sensor', None, 'Whether to read the BME680 '
+                  'ambient sensor. Defaults to reading it, except when '
+                  'replaying or with the stub detector, e.g. on machines '
+                  'without the sensor.')
+flags.DEFINE_float('ambient_period', 1, 'The time in seconds between ambient '
+                   'sensor readings.')
+flags.DEFINE_integer('ambient_window', 10, 'The number of ambient sensor '
+                     'readings to average over.')
+flags.DEFINE_string('replay', None, 'A recording of thermal frames to replay '
+                    'instead of streaming from the camera.')
+flags.DEFINE_float('replay_fps', None, 'The frame rate at which to replay '
+                   'recorded frames. Defaults to the recorded timing. Zero '
+                   'replays as fast as possible.')
+flags.DEFINE_integer('queue_size', 1, 'The number of frames buffered between '
+                     'processing stages. The oldest frames are dropped when '
+                     'a stage falls behind.')
+flags.DEFINE_integer('frame_buffer_slots', 3, 'The number of frames the '
+                     'camera can buffer, at least 3.')
+flags.DEFINE_list('cameras', None, 'The cameras to stream from, each by '
+                  'serial number or as bus:address. Defaults to the first '
+                  'camera found.')
+flags.DEFINE_enum('detection_schedule', 'round_robin', SCHEDULING_POLICIES,
+                  'How multiple cameras share the face detector: taking '
+                  'turns, or in batches of concurrent requests.')
+flags.DEFINE_bool('capture_process', False, 'Whether to stream from the '
+                  'camera in a separate process, which shares frames through '
+                  'shared memory.')
+flags.DEFINE_integer('metrics_port', None, 'A port to serve runtime metrics '
+                     'on in the Prometheus text format, at /metrics.')
+flags.DEFINE_string('metrics_address', '127.0.0.1', 'The address to serve '
+                    'runtime metrics on. Use 0.0.0.0 to allow remote '
+                    'scraping.')
+flags.DEFINE_string('events', None, 'A file to write face measurement events '
+                    'to, for later analysis.')
+flags.DEFINE_enum('events_format', 'jsonl', EVENT_FORMATS, 'How to write '
+                  'events: as JSON lines in rotating files, or into a SQLite '
+                  'database.')
+flags.DEFINE_integer('events_queue_size', 1000, 'The number of events '
+                     'buffered for writing. Further events are dropped.')
+flags.DEFINE_integer('events_batch_size', 100, 'The maximum number of events '
+                     'to write at once.')
+flags.DEFINE_integer('events_max_bytes', 10000000, 'The size at which to '
+                     'rotate JSON lines event files.')
+flags.DEFINE_integer('events_backup_count', 5, 'The number of rotated JSON '
+                     'lines event files to keep.')
+flags.DEFINE_string('record', None, 'A file to record all thermal frames from '
+                    'the camera to. With multiple cameras, the index of each '
+                    'camera is appended to the file name.')
 
 WINDOW_NAME = 'window'
 WINDOW_WIDTH = 640
 WINDOW_HEIGHT = 480
-LINE_COLOR = (255, 255, 255)
-LINE_THICKNESS = 2
-LABEL_COLOR = LINE_COLOR
-LABEL_FONT = cv2.FONT_HERSHEY_DUPLEX
-LABEL_SCALE = 1
-LABEL_THICKNESS = 2
-
-
-def get_temperature(temperatures, bbox):
-    # Consider the raw temperatures insides the face bounding box.
-    left = int(bbox[0, 0])
-    top = int(bbox[0, 1])
-    right = int(bbox[1, 0])
-    bottom = int(bbox[1, 1])
-    crop = temperatures[top:bottom, left:right]
-    if crop.size == 0:
-        return None
 
-    # Use the maximum temperature across the face.
-    return np.max(crop)
+# The image size to warm up the face detection with, the Lepton 3.5
+# resolution.
+WARM_UP_SHAPE = (120, 160)
 
 
 def format_temperature(temperature, add_unit=True):
@@ -70,161 +203,619 @@ def format_temperature(temperature, add_unit=True):
             return '%.f' % fahrenheit
 
 
-def main(_):
-    if FLAGS.detect:
-        # Initialize ambient sensors.
-        ambient = bme680.BME680(i2c_addr=bme680.I2C_ADDR_PRIMARY,
-                                i2c_device=SMBus(1))
-        # TODO: Tune settings.
-        ambient.set_humidity_oversample(bme680.OS_2X)
-        ambient.set_pressure_oversample(bme680.OS_4X)
-        ambient.set_temperature_oversample(bme680.OS_8X)
-        ambient.set_filter(bme680.FILTER_SIZE_3)
-        ambient.set_gas_status(bme680.DISABLE_GAS_MEAS)
-
-        # Load the face detection model.
-        face_detector = DetectionEngine(FLAGS.face_model)
-
-    # Start the frame processing loop.
-    with PureThermal() as camera:
-
-        # Initialize thermal image buffers.
-        input_shape = (camera.height(), camera.width())
-        raw_buffer = np.zeros(input_shape, dtype=np.int16)
-        scaled_buffer = np.zeros(input_shape, dtype=np.uint8)
-        if FLAGS.detect:
-            rgb_buffer = np.zeros((*input_shape, 3), dtype=np.uint8)
-        if FLAGS.visualize:
-            window_buffer = np.zeros((WINDOW_HEIGHT, WINDOW_WIDTH, 3),
-                                     dtype=np.uint8)
-        raw_scale_factor = (
-            FLAGS.max_temperature - FLAGS.min_temperature) // 255
-        window_scale_factor_x = WINDOW_WIDTH / camera.width()
-        window_scale_factor_y = WINDOW_HEIGHT / camera.height()
+def camera_device(camera_spec):
+    # Turn a --cameras entry into the keyword arguments selecting the device.
+    if camera_spec is None:
+        return {}
+    if ':' in camera_spec:
+        bus, address = camera_spec.split(':')
+        return {'bus': int(bus), 'address': int(address)}
+    return {'serial': camera_spec}
+
+
+def record_path(camera_index, num_cameras):
+    if num_cameras == 1:
+        return FLAGS.record
+    root, extension = os.path.splitext(FLAGS.record)
+    return '%s-%d%s' % (root, camera_index, extension)
+
+
+def open_recorder(camera_index, num_cameras):
+    # The capture process records frames itself.
+    if FLAGS.record and not FLAGS.replay and not FLAGS.capture_process:
+        return Recorder(record_path(camera_index, num_cameras))
+    return nullcontext()
+
+
+def open_event_sink(registry):
+    if not FLAGS.events or not FLAGS.detect:
+        return nullcontext()
+    if FLAGS.events_format == 'sqlite':
+        writer = SqliteWriter(FLAGS.events)
+    else:
+        writer = JsonlWriter(FLAGS.events, max_bytes=FLAGS.events_max_bytes,
+                             backup_count=FLAGS.events_backup_count)
+    event_sink = EventSink(writer, queue_size=FLAGS.events_queue_size,
+                           batch_size=FLAGS.events_batch_size)
+    registry.counter('fever_events_written_total', 'The number of '
+                     'measurement events written.',
+                     function=event_sink.written)
+    registry.counter('fever_events_dropped_total', 'The number of '
+                     'measurement events dropped because the writer fell '
+                     'behind or failed.', function=event_sink.dropped)
+    return event_sink
+
+
+def open_camera(recorder, camera_index, camera_spec, num_cameras):
+    if FLAGS.replay:
+        return ReplayFrameSource(FLAGS.replay, fps=FLAGS.replay_fps)
+    if FLAGS.capture_process:
+        # Only load multiprocessing when streaming from another process.
+        from capture import CaptureProcessFrameSource
+        return CaptureProcessFrameSource(
+            num_slots=FLAGS.frame_buffer_slots,
+            record_path=FLAGS.record and record_path(camera_index,
+                                                     num_cameras),
+            device=camera_device(camera_spec))
+
+    # Only load the UVC library when streaming from the actual camera.
+    from purethermal import PureThermal
+    return PureThermal(recorder=recorder, num_slots=FLAGS.frame_buffer_slots,
+                       **camera_device(camera_spec))
+
+
+# The runtime metrics of the processing of a single camera's frames.
+class StreamMetrics(object):
+    def __init__(self, registry, camera_index=0):
+        def stage_histogram(stage):
+            return registry.histogram(
+                'fever_stage_seconds', 'The time spent in each processing '
+                'stage.', camera=camera_index, stage=stage)
+        self.copy = stage_histogram('copy')
+        self.scale = stage_histogram('scale')
+        self.normalize = stage_histogram('normalize')
+        self.detect = stage_histogram('detect')
+        self.measure = stage_histogram('measure')
+        self.render = stage_histogram('render')
+        self.presence = stage_histogram('presence')
+        self.latency = registry.histogram(
+            'fever_frame_latency_seconds', 'The time from acquiring a frame '
+            'until it made it through all processing stages.',
+            camera=camera_index)
+
+        # Frame IDs count the frames captured by the camera.
+        self.frame_id = 0
+        registry.counter('fever_frames_captured_total', 'The number of '
+                         'frames captured by the camera.',
+                         function=lambda: self.frame_id, camera=camera_index)
+        self.frames_processed = registry.counter(
+            'fever_frames_processed_total', 'The number of frames which made '
+            'it through all processing stages.', camera=camera_index)
+        self.detections = registry.counter(
+            'fever_detections_total', 'The number of times face detection '
+            'ran.', camera=camera_index)
+        self.faces = registry.counter(
+            'fever_faces_total', 'The number of faces measured, summed over '
+            'all frames.', camera=camera_index)
+        self.empty_crops = registry.counter(
+            'fever_empty_crops_total', 'The number of faces whose bounding '
+            'box was empty.', camera=camera_index)
+        self.readings = registry.counter(
+            'fever_readings_total', 'The number of consolidated temperature '
+            'readings of people.', camera=camera_index)
+        self._presence_frames = {present: registry.counter(
+            'fever_presence_frames_total', 'The number of frames checked by '
+            'the presence gate, by whether there was presence.',
+            camera=camera_index, present=str(present).lower())
+            for present in [False, True]}
+
+    def presence_frames(self, present):
+        return self._presence_frames[present]
+
+
+# The data of a single frame as it moves through the processing stages.
+class Frame(object):
+    def __init__(self, frame_id, timestamp, slot, preprocessor, metrics,
+                 ambient=None):
+        self.start_time = time()
+        self.frame_id = frame_id
+        self.timestamp = timestamp
+        self.metrics = metrics
+        self.ambient = ambient
+
+        # The frame's preallocated buffers.
+        self.preprocessor = preprocessor
+        self.slot = slot
+        self.raw = preprocessor.raw(slot)
+        self.scaled = preprocessor.scaled(slot)
+
+        self.faces = []
+        self.face_stats = measure_faces(self.raw, [])
+
+    def release(self):
+        # Frees the frame's buffers for another frame once it is done or
+        # dropped.
+        self.preprocessor.release_slot(self.slot)
+
+
+def acquire(camera, ambient, preprocessor, metrics):
+    # Wait for buffers which no other frame is using, letting the camera drop
+    # frames meanwhile.
+    slot = preprocessor.acquire_slot(timeout=POLL_INTERVAL)
+    if slot is None:
+        return None
+
+    # Wait for a new frame instead of processing the same one again.
+    if not camera.wait_for_new_frame(timeout=POLL_INTERVAL):
+        preprocessor.release_slot(slot)
+        return None
+
+    # Attach the latest ambient sensor readings without waiting for the sensor.
+    ambient_snapshot = ambient.snapshot() if ambient else None
+
+    # Get the latest frame from the thermal camera and copy it.
+    with metrics.copy.time(), camera.frame_lock():
+        np.copyto(dst=preprocessor.raw(slot), src=camera.frame())
+        frame = Frame(camera.frame_id(), camera.frame_timestamp(), slot,
+                      preprocessor, metrics, ambient_snapshot)
+    metrics.frame_id = frame.frame_id
+
+    return frame
+
+
+def preprocess(frame):
+    frame.preprocessor.process(frame.slot)
+    timings = frame.preprocessor.timings(frame.slot)
+    frame.metrics.scale.observe(timings['scale'])
+    frame.metrics.normalize.observe(timings['normalize'])
+
+    return frame
+
+
+def detect(frame, face_detector, tracker, presence_gate=None):
+    # Predict where the tracked faces moved and only run the face detection
+    # when tracking alone isn't good enough.
+    frame.faces = tracker.predict(frame.timestamp)
+
+    # Skip the face detection when nothing warm is in view, and let any
+    # tracks expire.
+    if presence_gate:
+        with frame.metrics.presence.time():
+            present = presence_gate.update(frame.raw)
+        frame.metrics.presence_frames(present).inc()
+        logging.debug('Presence: %d warm pixels' % presence_gate.warm_pixels)
+        if not present:
+            frame.faces = tracker.miss()
+            return frame
+
+    if not tracker.needs_detection():
+        return frame
+
+    # Detect any faces in the frame.
+    with frame.metrics.detect.time():
+        faces = face_detector.detect(frame.scaled, FLAGS.face_confidence,
+                                     FLAGS.max_num_faces)
+    frame.metrics.detections.inc()
+    frame.faces = tracker.update(faces, frame.timestamp)
+
+    return frame
+
+
+def measure(frame, aggregator, frame_stack=None, correction_table=None,
+            event_sink=None, camera_index=0, log_prefix=''):
+    # Measure the temperatures of all faces at once, optionally averaged over
+    # recent frames to reduce the frame-to-frame noise of the sensor.
+    with frame.metrics.measure.time():
+        temperatures = frame.raw
+        if frame_stack:
+            frame_stack.push(frame.raw)
+            temperatures = frame_stack.mean()
+        frame.face_stats = measure_faces(
+            temperatures, [face.bounding_box for face in frame.faces],
+            percentile=FLAGS.temperature_percentile,
+            inner_fraction=FLAGS.inner_face_fraction)
+
+        # Correct for the attenuation over the distance, which is estimated
+        # from the face size, under the average ambient conditions.
+        if correction_table and frame.ambient and len(frame.faces):
+            correct_face_stats(
+                correction_table, frame.face_stats,
+                [face.bounding_box for face in frame.faces],
+                frame.raw.shape[1], frame.ambient.average)
+    frame.metrics.faces.inc(len(frame.faces))
+
+    # Only format per-frame details when they are actually logged.
+    debug = logging.level_debug()
+    if debug:
+        if len(frame.faces) == 1:
+            logging.debug('%s1 person' % log_prefix)
+        else:
+            logging.debug('%s%d people' % (log_prefix, len(frame.faces)))
+    ambient = frame.ambient.average if frame.ambient else None
+    for face, stats in zip(frame.faces, frame.face_stats):
+        if not stats['pixels']:
+            logging.warning('%sEmpty crop' % log_prefix)
+            frame.metrics.empty_crops.inc()
+            continue
+        temperature = stats[FLAGS.temperature_statistic]
+        face.track.temperatures.append(temperature)
+        if debug:
+            logging.debug('%sPerson %d: %s' % (
+                log_prefix, face.track_id, format_temperature(temperature)))
+        if event_sink:
+            event_sink.put(MeasurementEvent(
+                frame.timestamp, camera_index, frame.frame_id, face.track_id,
+                face.bounding_box, stats, ambient))
+
+        # Report each person once, when there are enough readings.
+        reading = aggregator.add(face.track_id, temperature, frame.timestamp)
+        if reading:
+            frame.metrics.readings.inc()
+            logging.info('%sPerson %d: %s (max %s, p%.f %s)' % (
+                log_prefix, reading.track_id,
+                format_temperature(reading.ewma),
+                format_temperature(reading.max),
+                FLAGS.reading_quantile * 100,
+                format_temperature(reading.quantile)))
+
+    return frame
+
+
+def render(frame, renderer, window_name=None, live_view=None,
+           camera_index=0):
+    # Only draw the frame when there is a window or somebody is watching the
+    # live view.
+    watching = live_view and live_view.watching(camera_index)
+    if not window_name and not watching:
+        return
+
+    with frame.metrics.render.time():
+        draw(frame, renderer)
+
+    if watching:
+        live_view.publish(camera_index, renderer.window_buffer())
+
+    if window_name:
+        # Draw the frame.
+        cv2.imshow(window_name, renderer.window_buffer())
+        cv2.waitKey(1)
+
+
+def open_live_view(num_cameras, registry):
+    if not FLAGS.live_view_port:
+        return nullcontext()
+    live_view = LiveView(num_cameras, FLAGS.live_view_port,
+                         address=FLAGS.live_view_address,
+                         quality=FLAGS.live_view_quality)
+    registry.counter('fever_live_view_frames_total', 'The number of frames '
+                     'encoded for the live view.', function=live_view.encoded)
+    return live_view
+
+
+def draw(frame, renderer):
+    if FLAGS.normalize_colors:
+        renderer.render(frame.scaled)
+    else:
+        renderer.render_raw(frame.raw)
 
+    # Draw the face bounding boxes and temperature.
+    for face, stats in zip(frame.faces, frame.face_stats):
+        if stats['pixels']:
+            label = format_temperature(stats[FLAGS.temperature_statistic],
+                                       add_unit=False)
+        else:
+            label = None
+        renderer.draw_face(face.bounding_box, label)
+
+
+def open_detector():
+    if FLAGS.detector == 'edgetpu':
+        return EdgeTpuDetector(FLAGS.face_model)
+    if FLAGS.detector == 'cpu':
+        return TfliteDetector(FLAGS.cpu_face_model,
+                              num_threads=FLAGS.detector_threads)
+    return StubDetector(FLAGS.stub_faces,
+                        latency=FLAGS.stub_latency / 1000)
+
+
+def load_detector():
+    # Load the face detection model and warm it up, e.g. by uploading it to
+    # the Edge TPU, so that the first frame doesn't pay for it. Returns the
+    # detector along with the duration of each step.
+    start_time = time()
+    face_detector = open_detector()
+    load_time = time()
+    face_detector.warm_up(WARM_UP_SHAPE)
+    return face_detector, [('model load', load_time - start_time),
+                           ('warm-up', time() - load_time)]
+
+
+# Times the phases of startup until the first processed frame and the first
+# measured face, and reports them in a single log line.
+class StartupReport(object):
+    def __init__(self):
+        self._start_time = time()
+        self._phase_time = self._start_time
+        self._phases = []
+        self._background_phases = []
+        self._reported = False
+        self._face_reported = False
+
+    def phase(self, name):
+        # Ends the phase with the given name.
+        phase_time = time()
+        self._phases.append((name, phase_time - self._phase_time))
+        self._phase_time = phase_time
+
+    def background_phases(self, phases):
+        # Adds phases which overlapped with others.
+        self._background_phases.extend(phases)
+
+    def frame(self, frame):
+        if not self._reported:
+            self.phase('first frame')
+            self._reported = True
+            message = 'Startup took %.f ms: %s' % (
+                (self._phase_time - self._start_time) * 1000,
+                self._format(self._phases))
+            if self._background_phases:
+                message += ' (%s in the background)' % self._format(
+                    self._background_phases)
+            logging.info(message)
+        if not self._face_reported and np.any(frame.face_stats['pixels']):
+            self._face_reported = True
+            logging.info('First face measured %.f ms after start' % (
+                (time() - self._start_time) * 1000))
+
+    def _format(self, phases):
+        return ', '.join('%s %.f ms' % (name, duration * 1000)
+                         for name, duration in phases)
+
+
+def use_ambient_sensor():
+    if not FLAGS.detect:
+        return False
+    if FLAGS.ambient_sensor is not None:
+        return FLAGS.ambient_sensor
+    return not FLAGS.replay and FLAGS.detector != 'stub'
+
+
+def open_ambient_sampler(registry):
+    if use_ambient_sensor():
+        read_histogram = registry.histogram(
+            'fever_ambient_read_seconds', 'The time spent reading the '
+            'ambient sensor.')
+        return AmbientSampler(open_bme680(), period=FLAGS.ambient_period,
+                              window=FLAGS.ambient_window,
+                              read_histogram=read_histogram)
+    return nullcontext()
+
+
+# The processing of the frames of a single camera.
+class CameraStream(object):
+    def __init__(self, camera, camera_index, num_cameras, ambient,
+                 face_detector, registry, correction_table=None,
+                 event_sink=None):
+        self.camera = camera
+        self.camera_index = camera_index
+        self.metrics = StreamMetrics(registry, camera_index)
+        if num_cameras == 1:
+            self.window_name = WINDOW_NAME
+            log_prefix = ''
+        else:
+            self.window_name = '%s %d' % (WINDOW_NAME, camera_index)
+            log_prefix = 'Camera %d: ' % camera_index
+
+        # Split the frame processing into stages which run concurrently on
+        # consecutive frames. Rendering happens on the main thread.
+        stages = [('preprocess', preprocess)]
+        if FLAGS.detect:
+            tracker = FaceTracker(
+                detect_interval=FLAGS.detect_interval,
+                iou_threshold=FLAGS.track_iou_threshold,
+                min_confidence=FLAGS.track_min_confidence)
+            if FLAGS.presence_gate:
+                self.presence_gate = PresenceGate(
+                    (camera.height(), camera.width()),
+                    FLAGS.min_temperature, FLAGS.max_temperature,
+                    min_pixels=FLAGS.presence_min_pixels,
+                    threshold=FLAGS.presence_threshold,
+                    background_rate=FLAGS.presence_background_rate,
+                    hold_frames=FLAGS.presence_hold)
+            else:
+                self.presence_gate = None
+            stages.append(('detect', partial(
+                detect, face_detector=face_detector, tracker=tracker,
+                presence_gate=self.presence_gate)))
+            aggregator = TemperatureAggregator(
+                min_samples=FLAGS.reading_samples,
+                max_people=FLAGS.max_tracked_people,
+                quantile=FLAGS.reading_quantile)
+            if FLAGS.temporal_frames > 1:
+                frame_stack = FrameStack((camera.height(), camera.width()),
+                                         FLAGS.temporal_frames)
+            else:
+                frame_stack = None
+            stages.append(('measure', partial(
+                measure, aggregator=aggregator, frame_stack=frame_stack,
+                correction_table=correction_table, event_sink=event_sink,
+                camera_index=camera_index, log_prefix=log_prefix)))
+
+        # Preallocate buffers for as many frames as can be in flight: one per
+        # queue slot, one per stage being worked on, plus the frames being
+        # acquired and rendered. Dropped frames release their buffers right
+        # away, so acquiring only waits if the main loop falls behind.
+        num_slots = (len(stages) + 1) * FLAGS.queue_size + len(stages) + 2
+        self.preprocessor = Preprocessor((camera.height(), camera.width()),
+                                         FLAGS.min_temperature,
+                                         FLAGS.max_temperature,
+                                         num_slots=num_slots)
+
+        if FLAGS.visualize or FLAGS.live_view_port:
+            self.renderer = Renderer((camera.height(), camera.width()),
+                                     WINDOW_WIDTH, WINDOW_HEIGHT,
+                                     quality=FLAGS.render_quality,
+                                     min_temperature=FLAGS.min_temperature,
+                                     max_temperature=FLAGS.max_temperature)
         if FLAGS.visualize:
             # Initialize the window.
-            cv2.namedWindow(WINDOW_NAME, cv2.WINDOW_NORMAL)
-            cv2.setWindowProperty(WINDOW_NAME, cv2.WND_PROP_FULLSCREEN,
+            cv2.namedWindow(self.window_name, cv2.WINDOW_NORMAL)
+            cv2.setWindowProperty(self.window_name, cv2.WND_PROP_FULLSCREEN,
                                   cv2.WINDOW_FULLSCREEN)
 
+        self.pipeline = Pipeline(
+            partial(acquire, camera, ambient, self.preprocessor,
+                    self.metrics), stages, queue_size=FLAGS.queue_size,
+            drop=Frame.release)
+
+        # Export the dropped frames counted by the camera and the pipeline, and
+        # the frames the camera delivered more than once or torn.
+        dropped_help = 'The number of frames dropped in front of each stage.'
+        registry.counter('fever_frames_dropped_total', dropped_help,
+                         function=camera.dropped_frames, camera=camera_index,
+                         stage='camera')
+        for stage in self.pipeline.dropped():
+            registry.counter('fever_frames_dropped_total', dropped_help,
+                             function=partial(self._pipeline_dropped, stage),
+                             camera=camera_index, stage=stage)
+        registry.counter('fever_frames_duplicated_total', 'The number of '
+                         'times a frame was read from the camera again.',
+                         function=camera.duplicated_frames,
+                         camera=camera_index)
+        registry.counter('fever_frames_torn_total', 'The number of frames '
+                         'discarded because the camera overwrote them while '
+                         'they were read.', function=camera.torn_frames,
+                         camera=camera_index)
+        self.last_time = time()
+
+    def window_open(self):
+        return cv2.getWindowProperty(self.window_name, 0) != -1
+
+    def _pipeline_dropped(self, stage):
+        return self.pipeline.dropped()[stage]
+
+
+def main(_):
+    if FLAGS.replay or not FLAGS.cameras:
+        camera_specs = [None]
+    else:
+        camera_specs = FLAGS.cameras
+
+    startup_report = StartupReport()
+    if FLAGS.detect:
+        # Load the face detection model in the background while the cameras
+        # start streaming.
+        executor = ThreadPoolExecutor(max_workers=1)
+        detector_future = executor.submit(load_detector)
+        executor.shutdown(wait=False)
+
+    registry = Registry()
+    with ExitStack() as stack:
+        if FLAGS.metrics_port:
+            stack.enter_context(MetricsServer(
+                registry, FLAGS.metrics_port, address=FLAGS.metrics_address))
+
+        ambient = stack.enter_context(open_ambient_sampler(registry))
+        startup_report.phase('ambient sensor')
+
+        event_sink = stack.enter_context(open_event_sink(registry))
+        live_view = stack.enter_context(open_live_view(len(camera_specs),
+                                                       registry))
+
+        if FLAGS.detect and FLAGS.attenuation_correction:
+            if not use_ambient_sensor():
+                logging.warning('Attenuation correction needs the ambient '
+                                'sensor, use --ambient_sensor')
+            correction_table = attenuation_table(FLAGS.attenuation_table)
+            startup_report.phase('attenuation table')
+        else:
+            correction_table = None
+
+        cameras = []
+        for camera_index, camera_spec in enumerate(camera_specs):
+            recorder = stack.enter_context(open_recorder(
+                camera_index, len(camera_specs)))
+            cameras.append(stack.enter_context(open_camera(
+                recorder, camera_index, camera_spec, len(camera_specs))))
+        startup_report.phase('cameras')
+
+        if FLAGS.detect:
+            face_detector, detector_phases = detector_future.result()
+            startup_report.phase('detector')
+            startup_report.background_phases(detector_phases)
+        else:
+            face_detector = None
+
+        # All cameras share the single detector.
+        if face_detector and len(camera_specs) > 1:
+            scheduler = stack.enter_context(DetectionScheduler(
+                face_detector, len(camera_specs),
+                policy=FLAGS.detection_schedule))
+
+        streams = []
+        for camera_index, camera in enumerate(cameras):
+            if face_detector and len(camera_specs) > 1:
+                camera_detector = scheduler.client(camera_index)
+            else:
+                camera_detector = face_detector
+            streams.append(CameraStream(camera, camera_index,
+                                        len(camera_specs), ambient,
+                                        camera_detector, registry,
+                                        correction_table=correction_table,
+                                        event_sink=event_sink))
+
+        # Start the frame processing loops.
+        for stream in streams:
+            stack.enter_context(stream.pipeline)
         while (not FLAGS.visualize or
-               cv2.getWindowProperty(WINDOW_NAME, 0) != -1):
+               all(stream.window_open() for stream in streams)):
             try:
-                start_time = time()
-
-                if FLAGS.detect:
-                    # Acquire ambient sensor readings.
-                    if not ambient.get_sensor_data():
-                        logging.warning('Ambient sensor data not ready')
-                    ambient_data = ambient.data
-                    logging.debug('Ambient temperature: %.f °C'
-                                  % ambient_data.temperature)
-                    logging.debug('Ambient pressure: %.f hPa'
-                                  % ambient_data.pressure)
-                    logging.debug('Ambient humidity: %.f %%'
-                                  % ambient_data.humidity)
-
-                # Get the latest frame from the thermal camera and copy it.
-                with camera.frame_lock():
-                    np.copyto(dst=raw_buffer, src=camera.frame())
-
-                # Map the raw temperature data to a normal range before
-                # reducing the bit depth and min/max normalizing for better
-                # contrast.
-                np.clip((raw_buffer - FLAGS.min_temperature) //
-                        raw_scale_factor, 0, 255, out=scaled_buffer)
-                cv2.normalize(src=scaled_buffer, dst=scaled_buffer,
-                              alpha=0, beta=255, norm_type=cv2.NORM_MINMAX)
-
-                if FLAGS.detect:
-                    # Convert to the expected RGB format.
-                    cv2.cvtColor(src=scaled_buffer, dst=rgb_buffer,
-                                 code=cv2.COLOR_GRAY2RGB)
-
-                    # Detect any faces in the frame.
-                    faces = face_detector.detect_with_image(
-                        Image.fromarray(rgb_buffer),
-                        threshold=FLAGS.face_confidence,
-                        top_k=FLAGS.max_num_faces,
-                        keep_aspect_ratio=True,  # Better quality.
-                        relative_coord=False,  # Expect pixel coordinates.
-                        resample=Image.BILINEAR)  # Good enough and fast.
-
-                    # TODO: Estimate distance based on face size.
-
-                    # TODO: Model thermal attenuation based on distance and
-                    #       ambient temperature, pressure, and humidity.
-
-                    # Find the (highest) temperature of each face.
-                    if len(faces) == 1:
-                        logging.info('1 person')
-                    else:
-                        logging.info('%d people' % len(faces))
-                    for face in faces:
-                        temperature = get_temperature(raw_buffer,
-                                                      face.bounding_box)
-                        if not temperature:
-                            logging.warning('Empty crop')
-                            continue
-                        logging.info(format_temperature(temperature))
-
-                if FLAGS.visualize:
-                    # Apply the colormap.
-                    turbo_buffer = TURBO_COLORMAP[scaled_buffer]
-
-                    # Resize for the window.
-                    cv2.cvtColor(src=turbo_buffer, dst=turbo_buffer,
-                                 code=cv2.COLOR_RGB2BGR)
-                    cv2.resize(src=turbo_buffer, dst=window_buffer,
-                               dsize=(WINDOW_WIDTH, WINDOW_HEIGHT),
-                               interpolation=cv2.INTER_CUBIC)
-
-                    if FLAGS.detect:
-                        # Draw the face bounding boxes and temperature.
-                        for face in faces:
-                            bbox = face.bounding_box
-                            top_left = (
-                                int(window_scale_factor_x * bbox[0, 0]),
-                                int(window_scale_factor_y * bbox[0, 1]))
-                            bottom_right = (
-                                int(window_scale_factor_x * bbox[1, 0]),
-                                int(window_scale_factor_y * bbox[1, 1]))
-                            cv2.rectangle(window_buffer, top_left,
-                                          bottom_right, LINE_COLOR,
-                                          LINE_THICKNESS)
-
-                            temperature = get_temperature(raw_buffer,
-                                                          face.bounding_box)
-                            if not temperature:
-                                continue
-                            label = format_temperature(temperature,
-                                                       add_unit=False)
-                            label_size, _ = cv2.getTextSize(label, LABEL_FONT,
-                                                            LABEL_SCALE,
-                                                            LABEL_THICKNESS)
-                            label_position = (
-                                (top_left[0] + bottom_right[0]) // 2 -
-                                label_size[0] // 2,
-                                (top_left[1] + bottom_right[1]) // 2 +
-                                label_size[1] // 2)
-                            cv2.putText(window_buffer, label, label_position,
-                                        LABEL_FONT, LABEL_SCALE, LABEL_COLOR,
-                                        LABEL_THICKNESS, cv2.LINE_AA)
-
-                    # Draw the frame.
-                    cv2.imshow(WINDOW_NAME, window_buffer)
-                    cv2.waitKey(1)
-
-                # Calculate timing stats.
-                duration = time() - start_time
-                logging.debug('Frame took %.f ms (%.2f Hz)' % (
-                    duration * 1000, 1 / duration))
+                for stream in streams:
+                    frame = stream.pipeline.get(
+                        timeout=POLL_INTERVAL / len(streams))
+                    if frame is None:
+                        continue
+
+                    if FLAGS.visualize or live_view:
+                        render(frame, stream.renderer,
+                               window_name=(stream.window_name
+                                            if FLAGS.visualize else None),
+                               live_view=live_view,
+                               camera_index=stream.camera_index)
+
+                    startup_report.frame(frame)
+
+                    # Calculate timing stats.
+                    end_time = time()
+                    stream.metrics.frames_processed.inc()
+                    stream.metrics.latency.observe(
+                        end_time - frame.start_time)
+                    logging.debug('Frame took %.f ms (%.2f Hz)' % (
+                        (end_time - frame.start_time) * 1000,
+                        1 / (end_time - stream.last_time)))
+                    logging.debug('Preprocessing took %s' % ', '.join(
+                        '%.2f ms (%s)' % (duration * 1000, step)
+                        for step, duration in stream.preprocessor.timings(
+                            frame.slot).items()))
+                    stream.last_time = end_time
+                    frame.release()
 
             # Stop on SIGINT.
             except KeyboardInterrupt:
                 break
 
+        for stream in streams:
+            logging.debug('Dropped frames: %d by camera, %s by pipeline, %d '
+                          'torn, %d duplicated' % (
+                              stream.camera.dropped_frames(),
+                              stream.pipeline.dropped(),
+                              stream.camera.torn_frames(),
+                              stream.camera.duplicated_frames()))
+            if FLAGS.detect and stream.presence_gate:
+                stats = stream.presence_gate.stats()
+                logging.debug('Presence in %d of %d frames' % (
+                    stats['present'], stats['frames']))
+
     if FLAGS.visualize:
         cv2.destroyAllWindows()
 
@@ -0,0 +1,64 @@
+from absl.testing import absltest
+from fever import acquire
+from fever import Frame
+from fever import preprocess
+from fever import StreamMetrics
+from framesource import ReplayFrameSource
+from metrics import Registry
+import numpy as np
+import os
+from pipeline import Pipeline
+from preprocess import Preprocessor
+import tempfile
+from time import sleep
+from time import time
+
+NUM_FRAMES = 20
+
+
+class PipelineSlotTest(absltest.TestCase):
+    def test_slow_stage_keeps_its_frame(self):
+        # Every recorded frame is filled with its own index, so that frames
+        # whose buffers were reused while in flight are easy to spot.
+        frames = np.repeat(np.arange(NUM_FRAMES, dtype=np.uint16),
+                           12 * 16).reshape(NUM_FRAMES, 12, 16)
+        path = os.path.join(tempfile.mkdtemp(), 'frames.npy')
+        np.save(path, frames)
+
+        mismatches = []
+
+        def slow_stage(frame):
+            # Hold on to the frame while the source keeps replaying as fast
+            # as possible and frames get dropped in the queues.
+            expected = (frame.frame_id - 1) % NUM_FRAMES
+            sleep(0.02)
+            if np.any(frame.raw != expected):
+                mismatches.append(frame.frame_id)
+            return frame
+
+        metrics = StreamMetrics(Registry())
+        stages = [('preprocess', preprocess), ('slow', slow_stage)]
+        preprocessor = Preprocessor((12, 16), 29815, 31815,
+                                    num_slots=3 * 1 + len(stages) + 2)
+        processed = 0
+        with ReplayFrameSource(path, fps=0) as camera, Pipeline(
+                lambda: acquire(camera, None, preprocessor, metrics), stages,
+                drop=Frame.release) as pipeline:
+            end_time = time() + 1
+            while time() < end_time:
+                frame = pipeline.get(timeout=0.1)
+                if frame is None:
+                    continue
+                sleep(0.01)
+                if np.any(frame.raw != (frame.frame_id - 1) % NUM_FRAMES):
+                    mismatches.append(frame.frame_id)
+                processed += 1
+                frame.release()
+
+        self.assertGreater(processed, 10)
+        self.assertGreater(pipeline.dropped()['preprocess'], 0)
+        self.assertEqual(mismatches, [])
+
+
+if __name__ == '__main__':
+    absltest.main()
@@ -0,0 +1,273 @@
+from ctypes import memmove
+import numpy as np
+from recording import is_recording
+from recording import Recording
+from threading import Condition
+from threading import Event
+from threading import Lock
+from threading import Thread
+from time import time
+
+
+# A thread-safe ring of preallocated frame buffers. The writer fills a slot
+# which is neither the latest frame nor being read, and then publishes it as
+# the latest frame. Readers pin the latest frame while holding the read lock,
+# so that slow readers never see torn or overwritten frames and never block the
+# writer for long. Frames are numbered consecutively and carry their capture
+# timestamp, so that consumers can wait for new frames and tell whether they
+# already saw the current one.
+class FrameBuffer(object):
+    def initialize(self, width, height, dtype, num_slots=3):
+        # With fewer than three slots, the writer could run out of free ones.
+        assert num_slots >= 3
+        self._shape = (height, width)
+        self._buffers = np.zeros((num_slots, *self._shape), dtype=dtype)
+        self._frame_bytes = self._buffers[0].nbytes
+        self._addresses = [buffer.ctypes.data for buffer in self._buffers]
+        self._write_slot = 0
+        self._latest_slot = None
+        self._read_slot = None
+        self._lock = Lock()
+        self._condition = Condition(self._lock)
+        self._read_lock = FrameReadLock(self)
+
+        # The first frame has ID 1, so that 0 means no frame yet.
+        self._frame_id = 0
+        self._timestamp = None
+        self._read_frame_id = 0
+        self._read_timestamp = None
+        self._dropped_frames = 0
+        self._duplicated_frames = 0
+
+    def write(self, data, timestamp=None):
+        slot = self._next_write_slot()
+        np.copyto(dst=self._buffers[slot], src=data.reshape(self._shape))
+        self._publish(slot, timestamp or time())
+
+    def write_from(self, address, size, timestamp=None):
+        # Copies a frame from memory owned by C code with a single memmove and
+        # returns the slot's buffer.
+        assert size == self._frame_bytes
+        slot = self._next_write_slot()
+        memmove(self._addresses[slot], address, size)
+        self._publish(slot, timestamp or time())
+        return self._buffers[slot]
+
+    def read(self):
+        assert self._read_slot is not None
+        return self._buffers[self._read_slot]
+
+    def read_lock(self):
+        return self._read_lock
+
+    def frame_id(self):
+        assert self._read_slot is not None
+        return self._read_frame_id
+
+    def timestamp(self):
+        assert self._read_slot is not None
+        return self._read_timestamp
+
+    def wait_for_new_frame(self, timeout=None):
+        # Blocks until there is a frame which wasn't read yet. Returns False
+        # if there was none before the timeout.
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: self._frame_id != self._read_frame_id, timeout)
+
+    def wait_for_read(self, timeout=None):
+        # Blocks until the latest frame was read. Returns False if it wasn't
+        # before the timeout.
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: self._frame_id == self._read_frame_id, timeout)
+
+    def dropped_frames(self):
+        # The number of frames which were overwritten without being read.
+        return self._dropped_frames
+
+    def duplicated_frames(self):
+        # The number of times a frame was read again.
+        return self._duplicated_frames
+
+    def _pin(self):
+        with self._condition:
+            assert self._read_slot is None
+            if self._read_frame_id == self._frame_id:
+                self._duplicated_frames += 1
+            self._read_slot = self._latest_slot
+            if self._read_slot is None:
+                # There was no frame yet.
+                self._read_slot = self._write_slot
+            self._read_frame_id = self._frame_id
+            self._read_timestamp = self._timestamp
+            self._condition.notify_all()
+
+    def _unpin(self):
+        with self._lock:
+            self._read_slot = None
+
+    def _next_write_slot(self):
+        # Only the writer changes the latest slot, so the slot stays free
+        # until it's published, even if a reader pins the latest one.
+        with self._lock:
+            slot = self._write_slot
+            while slot == self._latest_slot or slot == self._read_slot:
+                slot = (slot + 1) % len(self._buffers)
+        return slot
+
+    def _publish(self, slot, timestamp):
+        with self._condition:
+            if self._read_frame_id != self._frame_id:
+                self._dropped_frames += 1
+            self._latest_slot = slot
+            self._write_slot = (slot + 1) % len(self._buffers)
+            self._frame_id += 1
+            self._timestamp = timestamp
+            self._condition.notify_all()
+
+
+# Pins the latest frame of a FrameBuffer for reading while held.
+class FrameReadLock(object):
+    def __init__(self, frame_buffer):
+        self._frame_buffer = frame_buffer
+
+    def __enter__(self):
+        self._frame_buffer._pin()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._frame_buffer._unpin()
+
+
+# The interface shared by all sources of 16-bit thermal frames in centikelvin.
+# Sources are context managers and the current frame, its ID and its timestamp
+# may only be accessed while holding the frame lock, which is only meant for
+# a single consumer. By default, frames are
+# provided by a FrameBuffer in the _frame_buffer attribute.
+class FrameSource(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        pass
+
+    def frame(self):
+        return self._frame_buffer.read()
+
+    def frame_lock(self):
+        return self._frame_buffer.read_lock()
+
+    def frame_id(self):
+        return self._frame_buffer.frame_id()
+
+    def frame_timestamp(self):
+        return self._frame_buffer.timestamp()
+
+    def wait_for_new_frame(self, timeout=None):
+        return self._frame_buffer.wait_for_new_frame(timeout)
+
+    def dropped_frames(self):
+        return self._frame_buffer.dropped_frames()
+
+    def duplicated_frames(self):
+        return self._frame_buffer.duplicated_frames()
+
+    def torn_frames(self):
+        # The number of frames which were overwritten while being read, and
+        # discarded. Frames in a FrameBuffer are locked while read.
+        return 0
+
+    def width(self):
+        raise NotImplementedError()
+
+    def height(self):
+        raise NotImplementedError()
+
+
+# The approximate frame rate of the FLIR Lepton.
+DEFAULT_FPS = 9
+
+# How often to check whether replay was stopped while waiting for a read.
+POLL_INTERVAL = 0.1
+
+
+def load_frames(path):
+    # Map the recorded frames instead of reading them all into memory. Returns
+    # the frames and their capture timestamps, if known.
+    if is_recording(path):
+        recording = Recording(path)
+        frames, timestamps = recording.frames, recording.timestamps
+    else:
+        frames, timestamps = np.load(path, mmap_mode='r'), None
+    if frames.ndim != 3 or frames.dtype != np.uint16 or not len(frames):
+        raise ValueError('Expected non-empty (frames, height, width) uint16 '
+                         'data in %s' % path)
+    return frames, timestamps
+
+
+# Replays recorded frames as if they were streamed from a camera. By default
+# (fps=None) the recorded timing is reproduced, falling back to the camera's
+# frame rate if there are no timestamps. Otherwise, frames are replayed at a
+# fixed frame rate or as fast as the consumer reads them (fps=0).
+class ReplayFrameSource(FrameSource):
+    def __init__(self, path, fps=None, loop=True):
+        self._path = path
+        self._fps = fps
+        self._loop = loop
+        self._frame_buffer = FrameBuffer()
+
+    def __enter__(self):
+        self._frames, self._timestamps = load_frames(self._path)
+        _, self._frame_height, self._frame_width = self._frames.shape
+        self._frame_buffer.initialize(self._frame_width, self._frame_height,
+                                      np.uint16)
+
+        # Make the first frame available right away, like a camera would.
+        self._frame_buffer.write(self._frames[0])
+
+        self._stop_event = Event()
+        self._thread = Thread(target=self._replay, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._stop_event.set()
+        self._thread.join()
+
+    def width(self):
+        return self._frame_width
+
+    def height(self):
+        return self._frame_height
+
+    def _frame_times(self):
+        # The time of each frame relative to the first one, or None.
+        if self._fps == 0:
+            return None
+        if self._fps is None and self._timestamps is not None:
+            return self._timestamps - self._timestamps[0]
+        return np.arange(len(self._frames)) / (self._fps or DEFAULT_FPS)
+
+    def _replay(self):
+        frame_times = self._frame_times()
+        start_time = time()
+        index = 1
+        while not self._stop_event.is_set():
+            if index == len(self._frames):
+                if not self._loop:
+                    break
+                index = 0
+                start_time = time()
+
+            # Wait until the frame is due without drifting, or until the
+            # previous frame was read when replaying as fast as possible.
+            if frame_times is not None:
+                delay = start_time + frame_times[index] - time()
+                if delay > 0 and self._stop_event.wait(delay):
+                    break
+            elif not self._frame_buffer.wait_for_read(POLL_INTERVAL):
+                continue
+
+            self._frame_buffer.write(self._frames[index])
+            index += 1
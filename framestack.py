@@ -0,0 +1,98 @@
+import numpy as np
+
+
+def crop_slices(bbox, shape):
+    # The rows and columns of a [[left, top], [right, bottom]] bounding box,
+    # clipped to the image, or the whole image without a bounding box.
+    if bbox is None:
+        return slice(None), slice(None)
+    height, width = shape
+    left, top = np.clip(np.asarray(bbox[0], dtype=np.int64), 0,
+                        (width, height))
+    right, bottom = np.clip(np.asarray(bbox[1], dtype=np.int64), 0,
+                            (width, height))
+    return slice(top, bottom), slice(left, right)
+
+
+# Keeps the most recent raw frames in a preallocated ring and maintains their
+# per-pixel sum and sum of squares as frames come and go, so that the temporal
+# mean and variance cost O(pixels) per frame instead of reducing over all
+# frames. Sums are integers, so they don't drift. The sliding maximum uses the
+# van Herk/Gil-Werman scheme: the ring is filled in blocks, and the maximum is
+# that of the suffix of the previous block and the prefix of the current one.
+# Suffix maxima are computed once per block, so the cost is O(pixels) per
+# frame, amortized.
+class FrameStack(object):
+    def __init__(self, shape, capacity):
+        self._frames = np.zeros((capacity, *shape), dtype=np.uint16)
+        self._sum = np.zeros(shape, dtype=np.int64)
+        self._sum_squares = np.zeros(shape, dtype=np.int64)
+        self._squares = np.zeros(shape, dtype=np.int64)
+        self._suffix_max = np.zeros((capacity, *shape), dtype=np.uint16)
+        self._prefix_max = np.zeros(shape, dtype=np.uint16)
+        self._max = np.zeros(shape, dtype=np.uint16)
+        self._mean = np.zeros(shape, dtype=np.float32)
+        self._next_index = 0
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def push(self, frame):
+        index = self._next_index
+        capacity = len(self._frames)
+        slot = self._frames[index]
+        if self._count == capacity:
+            # Remove the oldest frame from the sums.
+            self._sum -= slot
+            np.multiply(slot, slot, out=self._squares, dtype=np.int64)
+            self._sum_squares -= self._squares
+        else:
+            self._count += 1
+
+        np.copyto(dst=slot, src=frame)
+        self._sum += slot
+        np.multiply(slot, slot, out=self._squares, dtype=np.int64)
+        self._sum_squares += self._squares
+
+        if index == 0:
+            np.copyto(dst=self._prefix_max, src=slot)
+        else:
+            np.maximum(self._prefix_max, slot, out=self._prefix_max)
+        if index == capacity - 1:
+            # The block is complete and the window is exactly the block.
+            # Accumulating frame by frame is faster than along the axis.
+            np.copyto(dst=self._suffix_max[-1], src=slot)
+            for suffix in range(capacity - 2, -1, -1):
+                np.maximum(self._frames[suffix], self._suffix_max[suffix + 1],
+                           out=self._suffix_max[suffix])
+            np.copyto(dst=self._max, src=self._prefix_max)
+        elif self._count == capacity:
+            np.maximum(self._suffix_max[index + 1], self._prefix_max,
+                       out=self._max)
+        else:
+            np.copyto(dst=self._max, src=self._prefix_max)
+
+        self._next_index = (index + 1) % capacity
+
+    def mean(self, bbox=None):
+        # The temporal mean of the frames, optionally of a crop only. The
+        # whole image is written into a reused buffer.
+        if bbox is None:
+            np.divide(self._sum, max(self._count, 1), out=self._mean,
+                      casting='unsafe')
+            return self._mean
+        rows, columns = crop_slices(bbox, self._sum.shape)
+        return (self._sum[rows, columns] / max(self._count, 1)).astype(
+            np.float32)
+
+    def variance(self, bbox=None):
+        rows, columns = crop_slices(bbox, self._sum.shape)
+        count = max(self._count, 1)
+        sums = self._sum[rows, columns].astype(np.float64)
+        return ((self._sum_squares[rows, columns] - sums * sums / count) /
+                count).astype(np.float32)
+
+    def max(self, bbox=None):
+        rows, columns = crop_slices(bbox, self._max.shape)
+        return self._max[rows, columns]
@@ -4,6 +4,7 @@ from ctypes import c_int
 from ctypes import CFUNCTYPE
 from ctypes import POINTER
 from ctypes import c_char
+from ctypes import c_char_p
 from ctypes import c_long
 from ctypes import c_size_t
 from ctypes import c_ubyte
@@ -52,6 +53,15 @@ class UvcDeviceHandle(Structure):
                 ('is_isight', c_ubyte)]
 
 
+class UvcDeviceDescriptor(Structure):
+    _fields_ = [('idVendor', c_uint16),
+                ('idProduct', c_uint16),
+                ('bcdUVC', c_uint16),
+                ('serialNumber', c_char_p),
+                ('manufacturer', c_char_p),
+                ('product', c_char_p)]
+
+
 class UvcStreamCtrl(Structure):
     _fields_ = [('bmHint', c_uint16),
                 ('bFormatIndex', c_uint8),
@@ -0,0 +1,138 @@
+from absl import logging
+import cv2
+from threading import Condition
+from threading import Thread
+
+BOUNDARY = b'frame'
+CONTENT_TYPE = 'multipart/x-mixed-replace; boundary=' + BOUNDARY.decode()
+
+# The time in seconds to wait for a new frame before checking whether the
+# server is stopping, and after which a client which doesn't read is
+# disconnected.
+POLL_INTERVAL = 0.5
+CLIENT_TIMEOUT = 10
+
+
+# Serves the rendered frames of each camera as an MJPEG stream over HTTP, at
+# /0, /1, and so on, and at / for the first camera. Frames are only encoded
+# while somebody is watching, and each frame is encoded once for all clients.
+# Every client waits for the latest frame on its own thread, so that slow
+# clients skip frames instead of holding up rendering.
+class LiveView(object):
+    def __init__(self, num_cameras, port, address='127.0.0.1', quality=80):
+        self._port = port
+        self._address = address
+        self._quality = quality
+        self._condition = Condition()
+        self._jpegs = [None] * num_cameras
+        self._sequences = [0] * num_cameras
+        self._clients = [0] * num_cameras
+        self._encoded = 0
+        self._stopped = False
+
+    def __enter__(self):
+        # Only load the HTTP server when the live view is actually served.
+        from http.server import BaseHTTPRequestHandler
+        from http.server import ThreadingHTTPServer
+
+        live_view = self
+
+        class Handler(BaseHTTPRequestHandler):
+            timeout = CLIENT_TIMEOUT
+
+            def do_GET(self):
+                camera = live_view._camera(self.path)
+                if camera is None:
+                    self.send_error(404)
+                    return
+                live_view._stream(self, camera)
+
+            def log_message(self, format, *args):
+                # Clients are logged when they connect and disconnect.
+                pass
+
+        self._server = ThreadingHTTPServer((self._address, self._port),
+                                           Handler)
+        self._thread = Thread(target=self._server.serve_forever,
+                              name='live view', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        self._server.shutdown()
+        self._thread.join()
+        self._server.server_close()
+
+    def watching(self, camera):
+        # Whether any client is watching the camera, i.e. whether to render
+        # and publish its frames.
+        return self._clients[camera] > 0
+
+    def publish(self, camera, image):
+        # Encode the BGR image for the clients of the camera, if any.
+        if not self._clients[camera]:
+            return
+        success, jpeg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY,
+                                                     self._quality])
+        if not success:
+            logging.warning('Failed to encode the live view')
+            return
+        with self._condition:
+            self._jpegs[camera] = jpeg.tobytes()
+            self._sequences[camera] += 1
+            self._encoded += 1
+            self._condition.notify_all()
+
+    def encoded(self):
+        return self._encoded
+
+    def _camera(self, path):
+        # The camera index of a request path, or None for unknown paths.
+        name = path.split('?')[0].strip('/') or '0'
+        if not name.isdigit() or int(name) >= len(self._clients):
+            return None
+        return int(name)
+
+    def _stream(self, handler, camera):
+        handler.send_response(200)
+        handler.send_header('Content-Type', CONTENT_TYPE)
+        handler.send_header('Cache-Control', 'no-cache')
+        handler.end_headers()
+
+        client = '%s:%d' % handler.client_address[:2]
+        logging.info('Live view client %s connected to camera %d' % (
+            client, camera))
+        with self._condition:
+            self._clients[camera] += 1
+            sequence = self._sequences[camera]
+        try:
+            while True:
+                # Take the latest frame, skipping any which were published
+                # while the previous one was being sent.
+                with self._condition:
+                    self._condition.wait_for(
+                        lambda: (self._stopped or
+                                 self._sequences[camera] != sequence),
+                        timeout=POLL_INTERVAL)
+                    if self._stopped:
+                        return
+                    if self._sequences[camera] == sequence:
+                        continue
+                    sequence = self._sequences[camera]
+                    jpeg = self._jpegs[camera]
+
+                handler.wfile.write(
+                    b'--%s\r\nContent-Type: image/jpeg\r\n'
+                    b'Content-Length: %d\r\n\r\n' % (BOUNDARY, len(jpeg)))
+                handler.wfile.write(jpeg)
+                handler.wfile.write(b'\r\n')
+        except OSError:
+            # The client disconnected or stopped reading.
+            pass
+        finally:
+            with self._condition:
+                self._clients[camera] -= 1
+            logging.info('Live view client %s disconnected' % client)
@@ -0,0 +1,69 @@
+import cv2
+import numpy as np
+
+# The temperature statistics of a face, in centikelvin: the maximum, a high
+# percentile which is robust against hot pixels, the mean over the inner part
+# of the bounding box, and the number of pixels in the bounding box.
+FACE_STATS_DTYPE = np.dtype([('max', np.float32),
+                             ('percentile', np.float32),
+                             ('mean', np.float32),
+                             ('pixels', np.int32)])
+
+
+def face_boxes(bboxes, shape):
+    # Stack [[left, top], [right, bottom]] bounding boxes into integer
+    # (left, top, right, bottom) rows, clipped to the image.
+    boxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4).astype(
+        np.int32)
+    height, width = shape
+    np.clip(boxes[:, 0::2], 0, width, out=boxes[:, 0::2])
+    np.clip(boxes[:, 1::2], 0, height, out=boxes[:, 1::2])
+    return boxes
+
+
+def box_sums(integral, boxes):
+    # Sum the values inside each box using a summed-area table.
+    left, top, right, bottom = boxes.T
+    return (integral[bottom, right] - integral[top, right] -
+            integral[bottom, left] + integral[top, left])
+
+
+def measure_faces(temperatures, bboxes, percentile=95, inner_fraction=0.5):
+    # Compute the statistics of all faces in one batch. Faces with empty
+    # crops have zero pixels and no other statistics.
+    boxes = face_boxes(bboxes, temperatures.shape)
+    stats = np.zeros(len(boxes), dtype=FACE_STATS_DTYPE)
+    if not len(boxes):
+        return stats
+
+    widths = np.maximum(boxes[:, 2] - boxes[:, 0], 0)
+    heights = np.maximum(boxes[:, 3] - boxes[:, 1], 0)
+    stats['pixels'] = widths * heights
+
+    # Average over the inner part of each box, which excludes the background
+    # and hair at the edges. One summed-area table serves all faces.
+    margin_x = (widths * (1 - inner_fraction) / 2).astype(np.int32)
+    margin_y = (heights * (1 - inner_fraction) / 2).astype(np.int32)
+    inner_boxes = np.stack([boxes[:, 0] + margin_x, boxes[:, 1] + margin_y,
+                            boxes[:, 2] - margin_x, boxes[:, 3] - margin_y],
+                           axis=1)
+    inner_pixels = ((inner_boxes[:, 2] - inner_boxes[:, 0]) *
+                    (inner_boxes[:, 3] - inner_boxes[:, 1]))
+    integral = cv2.integral(temperatures, sdepth=cv2.CV_64F)
+    inner_sums = box_sums(integral, inner_boxes)
+    np.divide(inner_sums, inner_pixels, out=stats['mean'],
+              where=inner_pixels > 0, casting='unsafe')
+
+    # Find the percentile and the maximum with a single partial sort of each
+    # crop.
+    for index, (left, top, right, bottom) in enumerate(boxes):
+        pixels = stats['pixels'][index]
+        if not pixels:
+            continue
+        values = temperatures[top:bottom, left:right].ravel()
+        rank = int(round(percentile / 100 * (pixels - 1)))
+        values = np.partition(values, (rank, pixels - 1))
+        stats['percentile'][index] = values[rank]
+        stats['max'][index] = values[-1]
+
+    return stats
@@ -0,0 +1,173 @@
+from bisect import bisect_left
+from threading import Lock
+from threading import Thread
+from time import perf_counter
+
+# The upper bounds of the histogram buckets for durations in seconds, from
+# sub-millisecond array operations to a stalled USB transfer.
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                    0.25, 0.5, 1, 2.5)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_labels(labels, extra_labels=()):
+    # Format label pairs like {camera="0",le="0.1"}, or nothing without labels.
+    pairs = list(labels) + list(extra_labels)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, value)
+                             for name, value in pairs)
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+# A monotonically increasing count. Counts kept elsewhere, e.g. the dropped
+# frames of a camera, are read from a function when the metrics are exported.
+class Counter(object):
+    def __init__(self, function=None):
+        self._function = function
+        self._value = 0
+        self._lock = Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self._value += amount
+
+    def value(self):
+        if self._function:
+            return self._function()
+        return self._value
+
+    def samples(self, name, labels):
+        yield name + format_labels(labels), self.value()
+
+
+# Counts observations in fixed buckets, so that observing is cheap and memory
+# is constant. Quantiles are estimated by the metrics backend.
+class Histogram(object):
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self._buckets = tuple(buckets)
+        self._counts = [0] * (len(self._buckets) + 1)
+        self._sum = 0
+        self._lock = Lock()
+
+    def observe(self, value):
+        index = bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self._sum += value
+
+    def time(self):
+        # A context manager which observes the duration of its block.
+        return Timer(self)
+
+    def samples(self, name, labels):
+        with self._lock:
+            counts = list(self._counts)
+            total = self._sum
+        cumulative = 0
+        for bound, count in zip(self._buckets + (float('inf'),), counts):
+            cumulative += count
+            yield (name + '_bucket' + format_labels(
+                labels, [('le', format_value(bound))]), cumulative)
+        yield name + '_sum' + format_labels(labels), total
+        yield name + '_count' + format_labels(labels), cumulative
+
+
+class Timer(object):
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start_time = perf_counter()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._histogram.observe(perf_counter() - self._start_time)
+
+
+# Holds all metrics by name and labels, and exports them in the Prometheus
+# text format.
+class Registry(object):
+    def __init__(self):
+        self._families = {}
+        self._lock = Lock()
+
+    def counter(self, name, help, function=None, **labels):
+        return self._metric(name, help, 'counter',
+                            lambda: Counter(function), labels)
+
+    def histogram(self, name, help, buckets=DURATION_BUCKETS, **labels):
+        return self._metric(name, help, 'histogram',
+                            lambda: Histogram(buckets), labels)
+
+    def export(self):
+        lines = []
+        with self._lock:
+            families = sorted(self._families.items())
+        for name, (type, help, metrics) in families:
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, type))
+            for labels, metric in sorted(metrics.items()):
+                for sample, value in metric.samples(name, labels):
+                    lines.append('%s %s' % (sample, format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def _metric(self, name, help, type, create, labels):
+        # Returns the existing metric with the same name and labels, if any.
+        labels = tuple(sorted((key, str(value))
+                              for key, value in labels.items()))
+        with self._lock:
+            _, _, metrics = self._families.setdefault(name, (type, help, {}))
+            if labels not in metrics:
+                metrics[labels] = create()
+            return metrics[labels]
+
+
+# Serves the metrics of a registry over HTTP on a background thread.
+class MetricsServer(object):
+    def __init__(self, registry, port, address='127.0.0.1'):
+        self._registry = registry
+        self._port = port
+        self._address = address
+
+    def __enter__(self):
+        # Only load the HTTP server when metrics are actually served.
+        from http.server import BaseHTTPRequestHandler
+        from http.server import HTTPServer
+
+        registry = self._registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.export().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', CONTENT_TYPE)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Don't log every scrape.
+                pass
+
+        self._server = HTTPServer((self._address, self._port), Handler)
+        self._thread = Thread(target=self._server.serve_forever,
+                              name='metrics', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._server.shutdown()
+        self._thread.join()
+        self._server.server_close()
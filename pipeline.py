@@ -0,0 +1,111 @@
+from absl import logging
+from collections import deque
+from threading import Condition
+from threading import Event
+from threading import Thread
+
+# How often idle workers check whether the pipeline was stopped.
+POLL_INTERVAL = 0.1
+
+
+# A thread-safe bounded queue which drops the oldest item instead of blocking
+# when it's full, so that consumers always get the most recent data. Dropped
+# items are passed to the optional drop function, e.g. to free their
+# resources.
+class DropOldestQueue(object):
+    def __init__(self, size, drop=None):
+        self._items = deque(maxlen=size)
+        self._condition = Condition()
+        self._dropped = 0
+        self._drop = drop
+
+    def put(self, item):
+        dropped_item = None
+        with self._condition:
+            if len(self._items) == self._items.maxlen:
+                self._dropped += 1
+                dropped_item = self._items.popleft()
+            self._items.append(item)
+            self._condition.notify()
+        if dropped_item is not None and self._drop:
+            self._drop(dropped_item)
+
+    def get(self, timeout=None):
+        # Returns None if no item arrived before the timeout.
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._items, timeout):
+                return None
+            return self._items.popleft()
+
+    def dropped(self):
+        return self._dropped
+
+
+# Runs processing stages concurrently, each on its own worker thread and
+# connected by bounded queues with drop-oldest backpressure. The source
+# produces items, each stage transforms them (or drops them by returning None)
+# and the output of the last stage is consumed with get(). Items dropped by
+# the queues or the stages are passed to the optional drop function.
+class Pipeline(object):
+    def __init__(self, source, stages, queue_size=1, drop=None):
+        self._source = source
+        self._stages = stages
+        self._drop = drop
+        self._queues = [DropOldestQueue(queue_size, drop=drop)
+                        for _ in range(len(stages) + 1)]
+        self._stop_event = Event()
+        self._error = None
+
+    def __enter__(self):
+        self._threads = [Thread(target=self._run_source, name='source',
+                                daemon=True)]
+        for index, (name, function) in enumerate(self._stages):
+            self._threads.append(Thread(
+                target=self._run_stage, name=name, daemon=True,
+                args=(function, self._queues[index], self._queues[index + 1])))
+        for thread in self._threads:
+            thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._stop_event.set()
+        for thread in self._threads:
+            thread.join()
+
+    def get(self, timeout=None):
+        # Returns the next output item, or None if there was none before the
+        # timeout. Errors in any of the stages are raised here.
+        if self._error:
+            raise self._error
+        return self._queues[-1].get(timeout)
+
+    def dropped(self):
+        # The number of items dropped in front of each stage and the output.
+        names = [name for name, _ in self._stages] + ['output']
+        return {name: queue.dropped()
+                for name, queue in zip(names, self._queues)}
+
+    def _run_source(self):
+        self._run(self._source, self._queues[0])
+
+    def _run_stage(self, function, input_queue, output_queue):
+        def process():
+            item = input_queue.get(POLL_INTERVAL)
+            if item is None:
+                return None
+            output = function(item)
+            if output is None and self._drop:
+                self._drop(item)
+            return output
+        self._run(process, output_queue)
+
+    def _run(self, process, output_queue):
+        try:
+            while not self._stop_event.is_set():
+                item = process()
+                if item is not None:
+                    output_queue.put(item)
+        except Exception as error:
+            logging.exception('Pipeline stage failed')
+            self._error = error
+            self._stop_event.set()
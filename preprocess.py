@@ -0,0 +1,80 @@
+from collections import deque
+import cv2
+import numpy as np
+from threading import Condition
+from time import time
+
+# The steps of preprocessing, in order, for timing purposes.
+PREPROCESS_STEPS = ['scale', 'normalize']
+
+
+def scale_lut(min_temperature, max_temperature):
+    # Precompute the mapping of every possible raw value to the normal range
+    # of body temperatures at reduced bit depth.
+    raw_scale_factor = (max_temperature - min_temperature) // 255
+    raw_values = np.arange(np.iinfo(np.uint16).max + 1, dtype=np.int32)
+    return np.clip((raw_values - min_temperature) // raw_scale_factor, 0,
+                   255).astype(np.uint8)
+
+
+# Maps raw 16-bit temperatures in centikelvin to 8-bit images for detection and
+# display without allocating memory per frame. Buffers are preallocated in
+# slots, one for each frame which may be in flight at the same time. Slots are
+# acquired for new frames and released once a frame is done or dropped, so
+# that a frame's buffers are never reused while it is still being processed.
+class Preprocessor(object):
+    def __init__(self, shape, min_temperature, max_temperature, num_slots=1):
+        self._lut = scale_lut(min_temperature, max_temperature)
+        self._raw_buffers = np.zeros((num_slots, *shape), dtype=np.uint16)
+        # Indexing needs native integers, which np.take would otherwise
+        # convert the raw values to in a temporary array on every frame.
+        self._index_buffers = np.zeros((num_slots, *shape), dtype=np.intp)
+        self._scaled_buffers = np.zeros((num_slots, *shape), dtype=np.uint8)
+        self._timings = np.zeros((num_slots, len(PREPROCESS_STEPS)))
+        self._free_slots = deque(range(num_slots))
+        self._condition = Condition()
+
+    def acquire_slot(self, timeout=None):
+        # Takes the least recently released slot, waiting for one to be
+        # released if all are in use. Returns None if none was before the
+        # timeout.
+        with self._condition:
+            if not self._condition.wait_for(lambda: self._free_slots,
+                                            timeout):
+                return None
+            return self._free_slots.popleft()
+
+    def release_slot(self, slot):
+        with self._condition:
+            assert slot not in self._free_slots
+            self._free_slots.append(slot)
+            self._condition.notify()
+
+    def raw(self, slot):
+        return self._raw_buffers[slot]
+
+    def scaled(self, slot):
+        return self._scaled_buffers[slot]
+
+    def process(self, slot):
+        raw = self._raw_buffers[slot]
+        scaled = self._scaled_buffers[slot]
+        timings = self._timings[slot]
+        start_time = time()
+
+        # Map the raw temperature data to a normal range while reducing the
+        # bit depth. Clipping avoids the internal buffering of bounds checks.
+        indices = self._index_buffers[slot]
+        np.copyto(dst=indices, src=raw, casting='safe')
+        np.take(self._lut, indices, out=scaled, mode='clip')
+        scale_time = time()
+        timings[0] = scale_time - start_time
+
+        # Min/max normalize for better contrast.
+        cv2.normalize(src=scaled, dst=scaled, alpha=0, beta=255,
+                      norm_type=cv2.NORM_MINMAX)
+        timings[1] = time() - scale_time
+
+    def timings(self, slot):
+        # The time in seconds spent on each step for the frame in the slot.
+        return dict(zip(PREPROCESS_STEPS, self._timings[slot]))
@@ -0,0 +1,68 @@
+import numpy as np
+
+# How much slower the background absorbs pixels with presence.
+PRESENCE_BACKGROUND_FACTOR = 0.1
+
+
+# Decides whether something warm and new is in view, so that face detection
+# can be skipped on empty scenes. Works on raw temperatures in centikelvin by
+# counting the pixels which are both in the band of skin temperatures and
+# warmer than a running background model. All buffers are preallocated.
+class PresenceGate(object):
+    def __init__(self, shape, min_temperature, max_temperature, min_pixels=20,
+                 threshold=100, background_rate=0.05, hold_frames=9):
+        self._min_temperature = min_temperature
+        self._max_temperature = max_temperature
+        self._min_pixels = min_pixels
+        self._threshold = threshold
+        self._background_rate = background_rate
+        self._hold_frames = hold_frames
+        self._background = None
+        self._difference = np.zeros(shape, dtype=np.float32)
+        self._in_band = np.zeros(shape, dtype=bool)
+        self._warmer = np.zeros(shape, dtype=bool)
+        self._below_max = np.zeros(shape, dtype=bool)
+        self._frames_since_presence = hold_frames + 1
+        self._frames = 0
+        self._present_frames = 0
+        self.warm_pixels = 0
+
+    def update(self, raw):
+        # Returns whether there is presence in the frame, or was until a few
+        # frames ago, and updates the background.
+        if self._background is None:
+            # Start with the background below the skin band, so that people
+            # who are already in view count as new until they're absorbed.
+            self._background = np.minimum(
+                raw, self._min_temperature - self._threshold).astype(
+                np.float32)
+
+        np.subtract(raw, self._background, out=self._difference)
+        np.greater(self._difference, self._threshold, out=self._warmer)
+        np.greater_equal(raw, self._min_temperature, out=self._in_band)
+        np.less_equal(raw, self._max_temperature, out=self._below_max)
+        np.logical_and(self._in_band, self._warmer, out=self._in_band)
+        np.logical_and(self._in_band, self._below_max, out=self._in_band)
+        self.warm_pixels = np.count_nonzero(self._in_band)
+
+        # Absorb changes into the background, much slower where there is
+        # presence, so that people standing still fade only after a while.
+        self._difference *= self._background_rate
+        np.multiply(self._difference, PRESENCE_BACKGROUND_FACTOR,
+                    out=self._difference, where=self._in_band)
+        self._background += self._difference
+
+        if self.warm_pixels >= self._min_pixels:
+            self._frames_since_presence = 0
+        else:
+            self._frames_since_presence += 1
+        present = self._frames_since_presence <= self._hold_frames
+
+        self._frames += 1
+        if present:
+            self._present_frames += 1
+        return present
+
+    def stats(self):
+        # The number of frames seen and those with presence.
+        return {'frames': self._frames, 'present': self._present_frames}
@@ -1,19 +1,22 @@
+from collections import namedtuple
 from ctypes import byref
-from ctypes import cast
 from ctypes import CFUNCTYPE
 from ctypes import create_string_buffer
-from ctypes import c_uint16
+from ctypes import c_uint8
 from ctypes import c_void_p
 from ctypes import POINTER
+from framesource import FrameBuffer
+from framesource import FrameSource
 from libuvc import LoadUvc
 from libuvc import UvcContext
 from libuvc import UvcDevice
+from libuvc import UvcDeviceDescriptor
 from libuvc import UvcDeviceHandle
 from libuvc import UvcFrame
 from libuvc import UvcFormatDesc
 from libuvc import UvcStreamCtrl
 import numpy as np
-from threading import Lock
+from time import time
 
 
 # The USB Vendor and Product IDs used to find the UVC device.
@@ -28,41 +31,13 @@ VIDEO_STREAM_FORMAT_GUID_Y16 = create_string_buffer(
 UVC_FRAME_FORMAT_Y16 = 13
 
 
-# A simple thread-safe double buffer.
-class FrameBuffer(object):
-    def initialize(self, width, height, dtype):
-        self._shape = (height, width)
-        self._buffers = [np.zeros(self._shape, dtype=dtype),
-                         np.zeros(self._shape, dtype=dtype)]
-        self._write_index = 0
-        self._read_index = 1
-        self._lock = Lock()
-
-    def write(self, data):
-        source = data.reshape(self._shape)
-        destination = self._buffers[self._write_index]
-        np.copyto(dst=destination, src=source)
-        self._swap_buffers()
-
-    def read(self):
-        assert self._lock.locked()
-        return self._buffers[self._read_index]
-
-    def read_lock(self):
-        return self._lock
-
-    def _swap_buffers(self):
-        with self._lock:
-            self._write_index, self._read_index = (self._read_index,
-                                                   self._write_index)
-
-
 # Dynamically load the UVC library.
 libuvc = LoadUvc()
+libuvc.uvc_get_bus_number.restype = c_uint8
+libuvc.uvc_get_device_address.restype = c_uint8
 
-# Define the FrameBuffer instance outside the PureThermal class to avoid scope
-# issues with C callbacks.
-frame_buffer = FrameBuffer()
+# A PureThermal device connected over USB. The serial number may be None.
+DeviceInfo = namedtuple('DeviceInfo', ['bus', 'address', 'serial'])
 
 
 def uvc_frame_callback(function):
@@ -70,24 +45,48 @@ def uvc_frame_callback(function):
     return CFUNCTYPE(None, POINTER(UvcFrame), c_void_p)(function)
 
 
-@uvc_frame_callback
-def frame_callback(frame_ptr, user_ptr):
-    frame = frame_ptr.contents
-    width = frame.width
-    height = frame.height
-
-    # Write the data from the callback into the frame buffer.
-    assert frame.data_bytes == 2 * width * height
-    data_ptr = cast(frame.data, POINTER(c_uint16 * width * height))
-    data = np.frombuffer(data_ptr.contents,
-                         dtype=np.uint16).reshape(height, width)
-    frame_buffer.write(data)
-
+def device_info(uvc_device):
+    # Returns the DeviceInfo of a UVC device, or None if it's not a
+    # PureThermal.
+    descriptor = POINTER(UvcDeviceDescriptor)()
+    if libuvc.uvc_get_device_descriptor(uvc_device, byref(descriptor)) < 0:
+        return None
+    try:
+        if (descriptor.contents.idVendor != USB_VENDOR_ID or
+                descriptor.contents.idProduct != USB_PRODUCT_ID):
+            return None
+        serial = descriptor.contents.serialNumber
+        return DeviceInfo(libuvc.uvc_get_bus_number(uvc_device),
+                          libuvc.uvc_get_device_address(uvc_device),
+                          serial.decode() if serial else None)
+    finally:
+        libuvc.uvc_free_device_descriptor(descriptor)
+
+
+def format_device(info):
+    return '%s (bus %d, address %d)' % (info.serial or 'unknown serial',
+                                        info.bus, info.address)
+
+
+# Streams 16-bit thermal frames from a PureThermal. Without a serial number or
+# USB bus and address, the first device found is used. Each instance has its
+# own frame buffer and callback, so several cameras can stream concurrently.
+class PureThermal(FrameSource):
+    def __init__(self, recorder=None, num_slots=3, serial=None, bus=None,
+                 address=None):
+        self._recorder = recorder
+        self._num_slots = num_slots
+        self._serial = serial
+        self._bus = bus
+        self._address = address
+        self._frame_buffer = FrameBuffer()
+
+        # Keep a reference to the C callback for as long as the camera
+        # streams, or it's garbage collected.
+        self._frame_callback = uvc_frame_callback(self._on_frame)
 
-class PureThermal(object):
     def __enter__(self):
         self._uvc_context = POINTER(UvcContext)()
-        self._uvc_device = POINTER(UvcDevice)()
         self._uvc_device_handle = POINTER(UvcDeviceHandle)()
         self._uvc_stream_ctrl = UvcStreamCtrl()
 
@@ -96,12 +95,7 @@ class PureThermal(object):
             raise RuntimeError('Failed to initialize UVC context (error %d)'
                                % uvc_error)
 
-        uvc_error = libuvc.uvc_find_device(self._uvc_context,
-                                           byref(self._uvc_device),
-                                           USB_VENDOR_ID, USB_PRODUCT_ID, 0)
-        if uvc_error < 0:
-            raise RuntimeError('Failed to find UVC device (error %d)'
-                               % uvc_error)
+        self._uvc_device = self._find_device()
 
         uvc_error = libuvc.uvc_open(self._uvc_device,
                                     byref(self._uvc_device_handle))
@@ -129,12 +123,12 @@ class PureThermal(object):
         # Initialize the frame buffer, now that the size is known.
         self._frame_width = frame_format.wWidth
         self._frame_height = frame_format.wHeight
-        frame_buffer.initialize(self._frame_width, self._frame_height,
-                                np.uint16)
+        self._frame_buffer.initialize(self._frame_width, self._frame_height,
+                                      np.uint16, num_slots=self._num_slots)
 
         uvc_error = libuvc.uvc_start_streaming(self._uvc_device_handle,
                                                byref(self._uvc_stream_ctrl),
-                                               frame_callback, None, 0)
+                                               self._frame_callback, None, 0)
         if uvc_error < 0:
             raise RuntimeError('Failed to start streaming (error %d)'
                                % uvc_error)
@@ -146,18 +140,60 @@ class PureThermal(object):
         libuvc.uvc_unref_device(self._uvc_device)
         libuvc.uvc_exit(self._uvc_context)
 
-    def frame(self):
-        return frame_buffer.read()
-
-    def frame_lock(self):
-        return frame_buffer.read_lock()
-
     def width(self):
         return self._frame_width
 
     def height(self):
         return self._frame_height
 
+    def _on_frame(self, frame_ptr, user_ptr):
+        # Keep the work on the streaming thread to a minimum, since it holds
+        # the GIL: a single copy into the next free slot of the frame buffer,
+        # whose addresses were computed when streaming started.
+        frame = frame_ptr.contents
+
+        # Not all versions of libuvc provide the capture time.
+        capture_time = frame.capture_time
+        timestamp = capture_time.tv_sec + capture_time.tv_usec / 1e6 or time()
+        data = self._frame_buffer.write_from(frame.data, frame.data_bytes,
+                                             timestamp)
+
+        # The recorder only copies the frame, too. Its file grows on another
+        # thread.
+        if self._recorder:
+            self._recorder.write(data, frame.sequence, timestamp)
+
+    def _find_device(self):
+        # Returns the first matching PureThermal, with a reference held.
+        device_list = POINTER(POINTER(UvcDevice))()
+        uvc_error = libuvc.uvc_get_device_list(self._uvc_context,
+                                               byref(device_list))
+        if uvc_error < 0:
+            raise RuntimeError('Failed to list UVC devices (error %d)'
+                               % uvc_error)
+
+        devices = []
+        try:
+            index = 0
+            while device_list[index]:
+                uvc_device = device_list[index]
+                index += 1
+                info = device_info(uvc_device)
+                if not info:
+                    continue
+                devices.append(info)
+                if ((self._serial is None or info.serial == self._serial) and
+                        (self._bus is None or info.bus == self._bus) and
+                        (self._address is None or
+                         info.address == self._address)):
+                    libuvc.uvc_ref_device(uvc_device)
+                    return uvc_device
+        finally:
+            libuvc.uvc_free_device_list(device_list, 1)
+
+        raise RuntimeError('Failed to find UVC device (found %s)' % (
+            ', '.join(map(format_device, devices)) or 'none'))
+
     def _as_iterator(self, pointer):
         while pointer:
             contents = pointer.contents
@@ -0,0 +1,203 @@
+import mmap
+import numpy as np
+from threading import Event
+from threading import Lock
+from threading import Thread
+
+# Recordings start with a fixed-size, zero-padded header followed by
+# fixed-size records, one per frame. Since all records have the same size, the
+# file doubles as its own frame index and any frame can be found without
+# scanning.
+RECORDING_MAGIC = b'FEVERREC'
+RECORDING_VERSION = 1
+HEADER_SIZE = 64
+HEADER_DTYPE = np.dtype([('magic', 'S8'),
+                         ('version', '<u4'),
+                         ('width', '<u4'),
+                         ('height', '<u4'),
+                         ('record_size', '<u4'),
+                         ('frame_count', '<u8')])
+
+# The number of records by which the file grows, ahead of time once fewer than
+# half of them are left.
+GROWTH_FRAMES = 256
+
+
+def record_dtype(width, height):
+    # The sequence number and capture timestamp (in seconds since the epoch)
+    # of each frame precede the 16-bit temperature values in centikelvin.
+    return np.dtype([('sequence', '<u4'),
+                     ('reserved', '<u4'),
+                     ('timestamp', '<f8'),
+                     ('frame', '<u2', (height, width))])
+
+
+def is_recording(path):
+    with open(path, 'rb') as file:
+        return file.read(len(RECORDING_MAGIC)) == RECORDING_MAGIC
+
+
+# Appends frames to a memory-mapped recording file. Writing a frame only copies
+# it into space which was mapped ahead of time. The file grows on a background
+# thread, so that frames can be written from a camera callback without
+# resizing and remapping the file there.
+class Recorder(object):
+    def __init__(self, path):
+        self._path = path
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def write(self, data, sequence, timestamp):
+        # The frame size is only known once the first frame arrives.
+        if not self._file:
+            self._open(data.shape[1], data.shape[0])
+
+        if self._frame_count == self._capacity:
+            # Growing in the background fell behind.
+            self._grow()
+
+        with self._lock:
+            record = self._records[self._frame_count]
+            record['sequence'] = sequence
+            record['timestamp'] = timestamp
+            np.copyto(dst=record['frame'],
+                      src=data.reshape(self._frame_shape))
+
+            # Only count the frame once it is complete, so that a partially
+            # written record is ignored if recording is interrupted.
+            self._frame_count += 1
+            self._header['frame_count'] = self._frame_count
+
+        if self._capacity - self._frame_count <= GROWTH_FRAMES // 2:
+            self._grow_event.set()
+
+    def close(self):
+        if not self._file:
+            return
+
+        self._closed = True
+        self._grow_event.set()
+        self._thread.join()
+
+        # Drop any unused capacity at the end of the file.
+        self._unmap()
+        self._file.truncate(HEADER_SIZE +
+                            self._frame_count * self._record_dtype.itemsize)
+        self._file.close()
+        self._file = None
+
+    def _open(self, width, height):
+        self._frame_shape = (height, width)
+        self._record_dtype = record_dtype(width, height)
+        self._frame_count = 0
+        self._file = open(self._path, 'w+b')
+        self._lock = Lock()
+        self._grow_lock = Lock()
+        self._use(self._map(GROWTH_FRAMES))
+
+        self._header['magic'] = RECORDING_MAGIC
+        self._header['version'] = RECORDING_VERSION
+        self._header['width'] = width
+        self._header['height'] = height
+        self._header['record_size'] = self._record_dtype.itemsize
+        self._header['frame_count'] = 0
+
+        self._closed = False
+        self._grow_event = Event()
+        self._thread = Thread(target=self._run, name='recorder', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            self._grow_event.wait()
+            self._grow_event.clear()
+            if self._closed:
+                return
+            self._grow()
+
+    def _grow(self):
+        # Extend and map the file before taking the lock, so that writing only
+        # waits for the new views to replace the old ones.
+        with self._grow_lock:
+            if self._capacity - self._frame_count > GROWTH_FRAMES // 2:
+                return
+            old_mmap = self._mmap
+            mapping = self._map(self._capacity + GROWTH_FRAMES)
+            with self._lock:
+                self._use(mapping)
+            old_mmap.flush()
+            old_mmap.close()
+
+    def _map(self, capacity):
+        # Returns the capacity, the memory map and the views into it.
+        self._file.truncate(HEADER_SIZE +
+                            capacity * self._record_dtype.itemsize)
+        memory_map = mmap.mmap(self._file.fileno(), 0)
+        header = np.frombuffer(memory_map, dtype=HEADER_DTYPE, count=1)[0]
+        records = np.frombuffer(memory_map, dtype=self._record_dtype,
+                                count=capacity, offset=HEADER_SIZE)
+        return capacity, memory_map, header, records
+
+    def _use(self, mapping):
+        self._capacity, self._mmap, self._header, self._records = mapping
+
+    def _unmap(self):
+        # Release all views into the memory map before closing it.
+        del self._header
+        del self._records
+        self._mmap.flush()
+        self._mmap.close()
+
+
+# Provides zero-copy access to the frames of a recording file.
+class Recording(object):
+    def __init__(self, path):
+        header = np.fromfile(path, dtype=HEADER_DTYPE, count=1)
+        if not len(header) or header[0]['magic'] != RECORDING_MAGIC:
+            raise ValueError('Not a recording: %s' % path)
+        header = header[0]
+        if header['version'] != RECORDING_VERSION:
+            raise ValueError('Unsupported recording version %d: %s'
+                             % (header['version'], path))
+
+        dtype = record_dtype(int(header['width']), int(header['height']))
+        frame_count = int(header['frame_count'])
+        if frame_count:
+            self._records = np.memmap(path, mode='r', offset=HEADER_SIZE,
+                                      dtype=dtype, shape=(frame_count,))
+        else:
+            # Empty files can't be memory-mapped.
+            self._records = np.zeros(0, dtype=dtype)
+
+    def __len__(self):
+        return len(self._records)
+
+    def __getitem__(self, index):
+        return self._records['frame'][index]
+
+    @property
+    def frames(self):
+        return self._records['frame']
+
+    @property
+    def sequences(self):
+        return self._records['sequence']
+
+    @property
+    def timestamps(self):
+        return self._records['timestamp']
+
+    def width(self):
+        return self.frames.shape[2]
+
+    def height(self):
+        return self.frames.shape[1]
+
+    def index_at(self, timestamp):
+        # Find the first frame captured at or after the timestamp.
+        return int(np.searchsorted(self.timestamps, timestamp))
@@ -0,0 +1,96 @@
+from colormap import TURBO_COLORMAP
+import cv2
+import numpy as np
+from preprocess import scale_lut
+
+# The interpolation used to resize the thermal image, by quality tier.
+INTERPOLATIONS = {
+    'fast': cv2.INTER_NEAREST,
+    'balanced': cv2.INTER_LINEAR,
+    'best': cv2.INTER_CUBIC,
+}
+
+LINE_COLOR = (255, 255, 255)
+LINE_THICKNESS = 2
+LABEL_COLOR = LINE_COLOR
+LABEL_FONT = cv2.FONT_HERSHEY_DUPLEX
+LABEL_SCALE = 1
+LABEL_THICKNESS = 2
+
+
+# Colorizes thermal images and resizes them for display, reusing the same
+# buffers for every frame. Colormaps are precomputed in BGR order, either for
+# 8-bit scaled images or directly for raw temperatures in centikelvin.
+class Renderer(object):
+    def __init__(self, input_shape, window_width, window_height,
+                 quality='best', min_temperature=None, max_temperature=None):
+        self._bgr_lut = np.ascontiguousarray(TURBO_COLORMAP[:, ::-1])
+        # The shape cv2.LUT expects for a table per channel.
+        self._channel_lut = self._bgr_lut.reshape(256, 1, 3)
+        if min_temperature is not None and max_temperature is not None:
+            # Fold the mapping to 8 bits into the colormap.
+            self._raw_bgr_lut = self._bgr_lut[scale_lut(min_temperature,
+                                                        max_temperature)]
+            self._index_buffer = np.zeros(input_shape, dtype=np.intp)
+        else:
+            self._raw_bgr_lut = None
+
+        self._color_buffer = np.zeros((*input_shape, 3), dtype=np.uint8)
+        self._window_buffer = np.zeros((window_height, window_width, 3),
+                                       dtype=np.uint8)
+        self._window_size = (window_width, window_height)
+        self._interpolation = INTERPOLATIONS[quality]
+        self._scale_x = window_width / input_shape[1]
+        self._scale_y = window_height / input_shape[0]
+
+    def window_buffer(self):
+        return self._window_buffer
+
+    def render(self, scaled):
+        self.colorize(scaled)
+        self.resize()
+
+    def render_raw(self, raw):
+        self.colorize_raw(raw)
+        self.resize()
+
+    def colorize(self, scaled):
+        # Apply the colormap to the 8-bit image in place: replicate it to all
+        # channels, then look up each channel in its own table.
+        cv2.cvtColor(scaled, cv2.COLOR_GRAY2BGR, dst=self._color_buffer)
+        cv2.LUT(self._color_buffer, self._channel_lut,
+                dst=self._color_buffer)
+
+    def colorize_raw(self, raw):
+        # Apply the colormap straight to the raw temperatures. Indexing needs
+        # native integers, which np.take would otherwise convert the raw
+        # values to in a temporary array. Clipping avoids the internal
+        # buffering of bounds checks.
+        assert self._raw_bgr_lut is not None
+        np.copyto(dst=self._index_buffer, src=raw, casting='safe')
+        np.take(self._raw_bgr_lut, self._index_buffer, axis=0,
+                out=self._color_buffer, mode='clip')
+
+    def resize(self):
+        # Scale the colorized image to the window.
+        cv2.resize(src=self._color_buffer, dst=self._window_buffer,
+                   dsize=self._window_size, interpolation=self._interpolation)
+
+    def draw_face(self, bbox, label=None):
+        # Draw the face bounding box and the label at its center.
+        top_left = (int(self._scale_x * bbox[0, 0]),
+                    int(self._scale_y * bbox[0, 1]))
+        bottom_right = (int(self._scale_x * bbox[1, 0]),
+                        int(self._scale_y * bbox[1, 1]))
+        cv2.rectangle(self._window_buffer, top_left, bottom_right, LINE_COLOR,
+                      LINE_THICKNESS)
+
+        if not label:
+            return
+        label_size, _ = cv2.getTextSize(label, LABEL_FONT, LABEL_SCALE,
+                                        LABEL_THICKNESS)
+        label_position = (
+            (top_left[0] + bottom_right[0]) // 2 - label_size[0] // 2,
+            (top_left[1] + bottom_right[1]) // 2 + label_size[1] // 2)
+        cv2.putText(self._window_buffer, label, label_position, LABEL_FONT,
+                    LABEL_SCALE, LABEL_COLOR, LABEL_THICKNESS, cv2.LINE_AA)
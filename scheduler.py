@@ -0,0 +1,122 @@
+from detector import Detector
+from threading import Condition
+from threading import Event
+from threading import Thread
+
+# How often the idle scheduler checks whether it was stopped.
+POLL_INTERVAL = 0.1
+
+# How long to wait for the other cameras to join a batch, in seconds.
+BATCH_WINDOW = 0.01
+
+SCHEDULING_POLICIES = ['round_robin', 'batch']
+
+
+# A pending detection of a single camera, completed by the scheduler.
+class DetectionRequest(object):
+    def __init__(self, image, threshold, top_k):
+        self.image = image
+        self.threshold = threshold
+        self.top_k = top_k
+        self.faces = None
+        self.error = None
+        self.done = Event()
+
+
+# Shares one face detector between several cameras, whose pipelines request
+# detections concurrently. Requests run on a single thread, either one at a
+# time taking turns between cameras, or in batches of the requests from all
+# cameras arriving within a short window.
+class DetectionScheduler(object):
+    def __init__(self, detector, num_cameras, policy='round_robin',
+                 batch_window=BATCH_WINDOW):
+        assert policy in SCHEDULING_POLICIES
+        self._detector = detector
+        self._policy = policy
+        self._batch_window = batch_window
+        self._pending = [None] * num_cameras
+        self._next_camera = 0
+        self._condition = Condition()
+        self._stop_event = Event()
+
+    def __enter__(self):
+        self._thread = Thread(target=self._run, name='scheduler', daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._stop_event.set()
+        self._thread.join()
+
+    def client(self, camera):
+        # A Detector for the pipeline of the camera with the given index.
+        return ScheduledDetector(self, camera)
+
+    def detect(self, camera, image, threshold, top_k):
+        # Blocks until the request of the camera was served. Each camera has
+        # at most one request pending, since its detection stage waits here.
+        request = DetectionRequest(image, threshold, top_k)
+        with self._condition:
+            assert self._pending[camera] is None
+            self._pending[camera] = request
+            self._condition.notify_all()
+        while not request.done.wait(POLL_INTERVAL):
+            if self._stop_event.is_set():
+                raise RuntimeError('Detection scheduler stopped')
+        if request.error:
+            raise request.error
+        return request.faces
+
+    def _next_requests(self):
+        # Returns the cameras and requests to serve next.
+        with self._condition:
+            if not self._condition.wait_for(
+                    lambda: any(self._pending), POLL_INTERVAL):
+                return []
+            if self._policy == 'batch':
+                self._condition.wait_for(
+                    lambda: all(self._pending), self._batch_window)
+                cameras = [camera for camera, request in enumerate(
+                    self._pending) if request]
+            else:
+                # Start looking after the camera which was served last.
+                num_cameras = len(self._pending)
+                camera = self._next_camera
+                while not self._pending[camera]:
+                    camera = (camera + 1) % num_cameras
+                cameras = [camera]
+                self._next_camera = (camera + 1) % num_cameras
+            requests = [self._pending[camera] for camera in cameras]
+            for camera in cameras:
+                self._pending[camera] = None
+            return list(zip(cameras, requests))
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            batch = self._next_requests()
+            if not batch:
+                continue
+
+            # All cameras detect with the same parameters.
+            _, first = batch[0]
+            try:
+                results = self._detector.detect_batch(
+                    [request.image for _, request in batch],
+                    first.threshold, first.top_k)
+            except Exception as error:
+                results = [None] * len(batch)
+                for _, request in batch:
+                    request.error = error
+            for (_, request), faces in zip(batch, results):
+                request.faces = faces
+                request.done.set()
+
+
+# The view of a DetectionScheduler for a single camera.
+class ScheduledDetector(Detector):
+    def __init__(self, scheduler, camera):
+        self._scheduler = scheduler
+        self._camera = camera
+
+    def detect(self, image, threshold, top_k):
+        return self._scheduler.detect(self._camera, image, threshold, top_k)
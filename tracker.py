@@ -0,0 +1,166 @@
+from collections import deque
+from collections import namedtuple
+import numpy as np
+
+# A snapshot of a track in a single frame. The bounding box follows the
+# [[left, top], [right, bottom]] convention of detections.
+TrackedFace = namedtuple('TrackedFace', ['track_id', 'bounding_box', 'score',
+                                         'track'])
+
+
+def iou_matrix(boxes_a, boxes_b):
+    # The intersection over union of all pairs of (n, 2, 2) bounding boxes.
+    top_left = np.maximum(boxes_a[:, None, 0], boxes_b[None, :, 0])
+    bottom_right = np.minimum(boxes_a[:, None, 1], boxes_b[None, :, 1])
+    intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+    area_a = np.prod(boxes_a[:, 1] - boxes_a[:, 0], axis=1)
+    area_b = np.prod(boxes_b[:, 1] - boxes_b[:, 0], axis=1)
+    union = area_a[:, None] + area_b[None, :] - intersection
+    return np.divide(intersection, union, out=np.zeros_like(intersection),
+                     where=union > 0)
+
+
+# A face followed across frames with a constant velocity motion model. The
+# confidence starts out as the detection score and decays with every frame
+# which is only predicted instead of detected.
+class Track(object):
+    def __init__(self, track_id, bbox, score, timestamp, history_size):
+        self.track_id = track_id
+        self.bounding_box = np.array(bbox, dtype=np.float64)
+        self.velocity = np.zeros((2, 2))  # Pixels per second.
+        self.score = score
+        self.confidence = score
+        self.misses = 0
+        self.detections = 1
+        self.timestamp = timestamp
+        self.temperatures = deque(maxlen=history_size)
+        self._detected_box = self.bounding_box.copy()
+        self._detected_timestamp = timestamp
+
+    def predict(self, timestamp, confidence_decay):
+        self.bounding_box += self.velocity * (timestamp - self.timestamp)
+        self.confidence *= confidence_decay
+        self.timestamp = timestamp
+
+    def update(self, bbox, score, velocity_smoothing):
+        # Blend the velocity observed since the last detection into the
+        # estimate, or start with it on the second detection. The box itself
+        # jumps to the detection.
+        bbox = np.array(bbox, dtype=np.float64)
+        duration = self.timestamp - self._detected_timestamp
+        if duration > 0:
+            observed = (bbox - self._detected_box) / duration
+            if self.detections == 1:
+                self.velocity = observed
+            else:
+                self.velocity += velocity_smoothing * (observed -
+                                                       self.velocity)
+        self.bounding_box = bbox
+        self.score = score
+        self.confidence = score
+        self.misses = 0
+        self.detections += 1
+        self._detected_box = bbox.copy()
+        self._detected_timestamp = self.timestamp
+
+    def snapshot(self):
+        return TrackedFace(self.track_id, self.bounding_box.copy(),
+                           self.score, self)
+
+
+# Propagates face bounding boxes between frames, so that face detection only
+# needs to run every few frames or when tracking becomes uncertain. Tracks are
+# associated with new detections greedily by intersection over union.
+class FaceTracker(object):
+    def __init__(self, detect_interval=1, iou_threshold=0.3,
+                 min_confidence=0.5, confidence_decay=0.9, max_misses=2,
+                 velocity_smoothing=0.5, history_size=100):
+        self._detect_interval = detect_interval
+        self._iou_threshold = iou_threshold
+        self._min_confidence = min_confidence
+        self._confidence_decay = confidence_decay
+        self._max_misses = max_misses
+        self._velocity_smoothing = velocity_smoothing
+        self._history_size = history_size
+        self._tracks = []
+        self._next_track_id = 1
+        self._frames_since_detection = detect_interval
+
+    def needs_detection(self):
+        # Detect when it's time to, when there is nothing to track (since new
+        # faces could appear) or when any track is uncertain: new tracks have
+        # no velocity estimate yet, and missed tracks need to be found again.
+        return (self._frames_since_detection >= self._detect_interval or
+                not self._tracks or
+                any(track.confidence < self._min_confidence or
+                    track.detections < 2 or track.misses
+                    for track in self._tracks))
+
+    def predict(self, timestamp):
+        # Move all tracks to where they are expected in the new frame.
+        self._frames_since_detection += 1
+        for track in self._tracks:
+            track.predict(timestamp, self._confidence_decay)
+        return self.faces()
+
+    def update(self, detections, timestamp):
+        # Associate the detections with the predicted tracks.
+        self._frames_since_detection = 0
+        matched_tracks = set()
+        matched_detections = set()
+        if self._tracks and detections:
+            ious = iou_matrix(
+                np.array([track.bounding_box for track in self._tracks]),
+                np.array([detection.bounding_box
+                          for detection in detections], dtype=np.float64))
+            for track_index, detection_index in zip(*np.unravel_index(
+                    np.argsort(ious, axis=None)[::-1], ious.shape)):
+                if ious[track_index, detection_index] < self._iou_threshold:
+                    break
+                if (track_index in matched_tracks or
+                        detection_index in matched_detections):
+                    continue
+                matched_tracks.add(track_index)
+                matched_detections.add(detection_index)
+                track = self._tracks[track_index]
+                detection = detections[detection_index]
+                track.update(detection.bounding_box, detection.score,
+                             self._velocity_smoothing)
+
+        tracks = self._count_misses(matched_tracks)
+
+        # Start new tracks for new faces.
+        for detection_index, detection in enumerate(detections):
+            if detection_index in matched_detections:
+                continue
+            tracks.append(Track(self._next_track_id, detection.bounding_box,
+                                detection.score, timestamp,
+                                self._history_size))
+            self._next_track_id += 1
+
+        self._tracks = tracks
+        return self.faces()
+
+    def miss(self):
+        # Count a miss for all tracks without detecting, e.g. when nothing is
+        # in view, so that the tracks expire. The next detection isn't
+        # postponed.
+        self._tracks = self._count_misses(set())
+        return self.faces()
+
+    def _count_misses(self, matched_tracks):
+        # Forget tracks which weren't detected repeatedly.
+        tracks = []
+        for track_index, track in enumerate(self._tracks):
+            if track_index not in matched_tracks:
+                track.misses += 1
+                if track.misses > self._max_misses:
+                    continue
+            tracks.append(track)
+        return tracks
+
+    def faces(self):
+        # Tracks which the last detection missed are only kept to associate
+        # later detections, since their boxes likely cover background.
+        return [track.snapshot() for track in self._tracks
+                if not track.misses]